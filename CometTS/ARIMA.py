@@ -1,11 +1,17 @@
 import matplotlib.dates as mdates
-from tqdm import tqdm as tqdm
 import datetime
+import warnings
 import numpy as np
 import pandas as pd
 import seaborn as sns
 import argparse
+import hashlib
+import json
 import os
+import rasterio
+from multiprocessing import Pool
+from tqdm import tqdm
+from CometTS.CometTS import read_stats, load_cube, replace_file
 sns.set(color_codes=True)
 
 
@@ -89,15 +95,732 @@ def timeseries_trend(gdf3, CMA_Val=3, CutoffDate="2017/08/31", Uncertainty=2):
         return gdf3
 
 
-def run_arima(CometTSOutputCSV="/San_Juan_FullStats.csv", outname="/FullStats_timeseries_trend.csv", CMA_Val=3, CutoffDate="2017/12/31", Uncertainty=2):
+def centered_mean(values, window):
+    """Centered moving average down the first axis of an array, the same as
+    pandas rolling(window, center=True).mean() on every column at once.  NaN
+    where the window is incomplete or holds a NaN."""
+    valid = np.isfinite(values)
+    zeros = np.zeros((1,) + values.shape[1:])
+    sums = np.concatenate([zeros, np.cumsum(np.where(valid, values, 0), axis=0)])
+    counts = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+    out = np.full(values.shape, np.nan)
+    n = values.shape[0]
+    if window > n:
+        return out
+    # The mean of values[i - window + 1:i + 1] is reported at i - (window - 1) // 2
+    full = (counts[window:] - counts[:-window]) == window
+    means = (sums[window:] - sums[:-window]) / window
+    start = window - 1 - (window - 1) // 2
+    out[start:start + n - window + 1] = np.where(full, means, np.nan)
+    return out
+
+
+def pixel_trend(stack, dates, CMA_Val=3, CutoffDate="2017/08/31", Uncertainty=2):
+    """The timeseries_trend model fit to every pixel of a (time, y, x) stack at
+    once, without a loop per pixel.  Seasonal indices are the monthly means of
+    each value over its centered moving average before CutoffDate, the trend a
+    least squares line through the deseasonalized values, and the error band
+    Uncertainty times their mean absolute error.
+
+    Arguments
+    ---------
+    stack : a :class:`numpy.array`
+        A (time, y, x) array with NaN for NoData, i.e. the 'data' of load_cube.
+    dates : list
+        The date of each time step (YYYY-MM-DD), in ascending order.
+    CMA_Val, CutoffDate, Uncertainty :
+        See timeseries_trend.
+
+    Returns
+    -------
+    trend : dict
+        'Slope' and 'SeasonalError' (y, x) arrays, the trend per day and the
+        error band half width, and 'SeasonalForecast' and 'Anomaly' (time, y,
+        x) arrays.  Anomaly is 1 above the error band, -1 below it and 0
+        otherwise.  Pixels without a trend are NaN (0 for Anomaly).
+    """
+    shape = stack.shape
+    values = np.asarray(stack, dtype='float64').reshape(shape[0], -1)
+    xdate = mdates.datestr2num(list(dates))
+    months = pd.DatetimeIndex(dates).month.values
+    xcutoff = mdates.date2num(datetime.datetime.strptime(CutoffDate, '%Y/%m/%d').date())
+    before = xdate <= xcutoff
+    pre = values[before]
+
+    # Seasonal indices, the monthly mean of value / centered moving average
+    div = pre / centered_mean(pre, CMA_Val)
+    valid = np.isfinite(div)
+    seasonal = np.full(values.shape, np.nan)
+    for month in np.unique(months[before]):
+        rows = months[before] == month
+        count = valid[rows].sum(axis=0)
+        total = np.where(valid[rows], div[rows], 0).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            seasonal[months == month] = np.where(count > 0, total / count, np.nan)
+
+    # Least squares trend through the deseasonalized values, per pixel
+    deseasonalized = pre / seasonal[before]
+    valid = np.isfinite(deseasonalized)
+    x = (xdate[before] - xdate[0])[:, None]
+    n = valid.sum(axis=0)
+    y = np.where(valid, deseasonalized, 0)
+    sx = np.where(valid, x, 0).sum(axis=0)
+    sy = y.sum(axis=0)
+    sxx = np.where(valid, x * x, 0).sum(axis=0)
+    sxy = (np.where(valid, x, 0) * y).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        intercept = (sy - slope * sx) / n
+        # A single point is fit as numpy.polyfit does on the date numbers
+        # (see linear_fit), moved to x relative to the first date
+        single = sy / (2 * (xdate[0] + sx))
+        slope = np.where(n == 1, single, slope)
+        intercept = np.where(n == 1, sy / 2 + single * xdate[0], intercept)
+
+    forecast = seasonal * (slope * (xdate - xdate[0])[:, None] + intercept)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        # Pixels without any data have no error band
+        warnings.simplefilter('ignore', RuntimeWarning)
+        error = Uncertainty * np.nanmean(np.abs(forecast[before] - pre), axis=0) \
+            if before.any() else np.full(slope.shape, np.nan)
+        anomaly = (values > forecast + error).astype('int8') - (values < forecast - error).astype('int8')
+    return {'Slope': slope.reshape(shape[1:]),
+            'SeasonalError': error.reshape(shape[1:]),
+            'SeasonalForecast': forecast.reshape(shape),
+            'Anomaly': anomaly.reshape(shape)}
+
+
+def write_trend_maps(cube_dir, outdir, CMA_Val=3, CutoffDate="2017/08/31", Uncertainty=2):
+    """Fit pixel_trend to a data cube (see CometTS.build_cube) and save the
+    results as GeoTIFFs on the cube grid: Trend_Slope.tif (trend per day),
+    SeasonalForecast.tif and Anomaly.tif (one band per date, described by the
+    date).
+
+    Arguments
+    ---------
+    cube_dir : str
+        The data cube directory.
+    outdir : str
+        The directory to write the GeoTIFFs to.
+    CMA_Val, CutoffDate, Uncertainty :
+        See timeseries_trend.
+
+    Returns
+    -------
+    trend : dict
+        The pixel_trend results.
+    """
+    cube = load_cube(cube_dir)
+    trend = pixel_trend(cube['data'], cube['dates'], CMA_Val, CutoffDate, Uncertainty)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    profile = {'driver': 'GTiff', 'height': cube['data'].shape[1], 'width': cube['data'].shape[2],
+               'crs': cube['crs'], 'transform': cube['affine'], 'compress': 'deflate'}
+    for name, key, dtype, nodata in [('Trend_Slope', 'Slope', 'float32', np.nan),
+                                     ('SeasonalForecast', 'SeasonalForecast', 'float32', np.nan),
+                                     ('Anomaly', 'Anomaly', 'int8', None)]:
+        bands = trend[key]
+        if bands.ndim == 2:
+            bands = bands[None]
+        with rasterio.open(os.path.join(outdir, name + '.tif'), 'w', count=bands.shape[0],
+                           dtype=dtype, nodata=nodata, **profile) as dst:
+            dst.write(bands.astype(dtype))
+            if bands.shape[0] == len(cube['dates']):
+                dst.descriptions = tuple(cube['dates'])
+    return trend
+
+
+def group_positions(group):
+    """The position of each row within its group, for rows sorted by group."""
+    index = np.arange(len(group))
+    start = np.r_[True, group[1:] != group[:-1]] if len(group) else np.zeros(0, bool)
+    return index - np.maximum.accumulate(np.where(start, index, 0))
+
+
+def grouped_centered_mean(values, group, window):
+    """centered_mean of each group of a 1-D array sorted by group, the same as
+    pandas rolling(window, center=True).mean() per group."""
+    out = np.full(len(values), np.nan)
+    if len(values) < window:
+        return out
+    pos = group_positions(group)
+    length = np.bincount(group)[group]
+    valid = np.isfinite(values)
+    sums = np.r_[0, np.cumsum(np.where(valid, values, 0))]
+    counts = np.r_[0, np.cumsum(valid)]
+    # The mean of the window ending at row j is reported at j - (window - 1) // 2
+    end = np.arange(window - 1, len(values))
+    full = ((counts[end + 1] - counts[end + 1 - window]) == window) & (pos[end] >= window - 1)
+    out[end - (window - 1) // 2] = np.where(full, (sums[end + 1] - sums[end + 1 - window]) / window, np.nan)
+    out[pos + (window - 1) // 2 >= length] = np.nan
+    return out
+
+
+def grouped_mean(values, group, ngroups):
+    """The mean of each group skipping NaN, as pandas groupby().mean() does.
+    NaN for groups without any values."""
+    valid = ~np.isnan(values)
+    sums = np.bincount(group, weights=np.where(valid, values, 0), minlength=ngroups)
+    counts = np.bincount(group, weights=valid, minlength=ngroups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def grouped_fit_sums(x, y, group, ngroups):
+    """The sums a least squares line through the finite (x, y) points of each
+    group is fit from.  Sums are taken about the first x of each group (x0) to
+    keep their precision.  Returns a dict of x0, n, sx, sy, sxx and sxy arrays."""
+    valid = np.isfinite(x) & np.isfinite(y)
+    x0 = np.zeros(ngroups)
+    first = np.nonzero(valid)[0][::-1]
+    x0[group[first]] = x[first]
+    xc = np.where(valid, x - x0[group], 0)
+    y = np.where(valid, y, 0)
+    return {'x0': x0,
+            'n': np.bincount(group, weights=valid, minlength=ngroups),
+            'sx': np.bincount(group, weights=xc, minlength=ngroups),
+            'sy': np.bincount(group, weights=y, minlength=ngroups),
+            'sxx': np.bincount(group, weights=xc * xc, minlength=ngroups),
+            'sxy': np.bincount(group, weights=xc * y, minlength=ngroups)}
+
+
+def linear_fit(sums):
+    """The slope and intercept of a least squares line from grouped_fit_sums,
+    in closed form.  A single point is fit the way :func:`numpy.polyfit` does."""
+    x0, n, sx, sy, sxx, sxy = [sums[key] for key in ('x0', 'n', 'sx', 'sy', 'sxx', 'sxy')]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        intercept = (sy - slope * sx) / n - slope * x0
+        # polyfit's minimum norm solution through one point
+        slope = np.where(n == 1, sy / (2 * (x0 + sx)), slope)
+        intercept = np.where(n == 1, sy / 2, intercept)
+    return slope, intercept
+
+
+def check_bands(main_gdf):
+    """The models fit one series per ID, so refuse statistics of several bands
+    (the 'band' column of a multi-band run), whose rows share each ID and date."""
+    if 'band' in main_gdf.columns and main_gdf['band'].nunique() > 1:
+        raise ValueError("Statistics of more than one band (" + ", ".join(map(str, pd.unique(main_gdf['band']))) +
+                         "), select a single band first, i.e. main_gdf[main_gdf['band'] == band]")
+
+
+def sort_series(main_gdf, ids):
+    """Sort statistics by ID (in the order of ids) then date, and work out the
+    group (index into ids, -1 if not in ids), matplotlib date number and month
+    of every row."""
+    check_bands(main_gdf)
+    group = pd.Index(ids).get_indexer(main_gdf['ID'])
+    dates = pd.DatetimeIndex(pd.to_datetime(main_gdf['date']))
+    order = np.lexsort((dates.values, group))
+    gdf3 = main_gdf.iloc[order].reset_index(drop=True)
+    group, dates = group[order], dates[order]
+    unique_dates, date_index = np.unique(dates.values, return_inverse=True)
+    xdate = mdates.date2num(pd.DatetimeIndex(unique_dates).to_pydatetime())[date_index]
+    return gdf3, group, xdate, dates.month.values
+
+
+def arima_state(main_gdf, CMA_Val=3, CutoffDate="2017/08/31", Uncertainty=2):
+    """Fit the timeseries_trend model of every polygon ID and summarize it by
+    its sufficient statistics.  The model only depends on the rows before
+    CutoffDate, so rows after it can be scored from the state alone (see
+    score_arima) without the rows it was fit from.
+
+    Arguments
+    ---------
+    main_gdf : a :class:`pandas.DataFrame`
+        The statistics output by CometTS, for any number of IDs.
+    CMA_Val, CutoffDate, Uncertainty :
+        See timeseries_trend.
+
+    Returns
+    -------
+    state : dict
+        'ID', the per ID and month seasonal index sums, counts and rows
+        ('seasonal_sum', 'seasonal_count', 'seasonal_rows', shaped (IDs, 12)),
+        the trend regression sums (see grouped_fit_sums), the absolute error
+        sum and count ('error_sum', 'error_count') and the settings.
+    """
+    ids = pd.unique(main_gdf['ID'])
+    gdf3, group, xdate, month = sort_series(main_gdf, ids)
+    xcutoff = mdates.date2num(datetime.datetime.strptime(CutoffDate, '%Y/%m/%d').date())
+    before = xdate <= xcutoff
+    group, xdate, month = group[before], xdate[before], month[before]
+    y = gdf3['mean'].values.astype('float64')[before]
+
+    # Seasonal indices per ID and month, skipping NaN as pandas does
+    div = y / grouped_centered_mean(y, group, CMA_Val)
+    season = group * 12 + month - 1
+    valid = ~np.isnan(div)
+    size = len(ids) * 12
+    state = {'ID': np.asarray(ids),
+             'seasonal_sum': np.bincount(season, weights=np.where(valid, div, 0), minlength=size),
+             'seasonal_count': np.bincount(season, weights=valid, minlength=size),
+             'seasonal_rows': np.bincount(season, minlength=size)}
+    for key in ('seasonal_sum', 'seasonal_count', 'seasonal_rows'):
+        state[key] = state[key].reshape(len(ids), 12)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        seasonal = state['seasonal_sum'] / state['seasonal_count']
+    trend_index = seasonal[group, month - 1]
+
+    # Trend of the deseasonalized values and its absolute error, per ID
+    state.update(grouped_fit_sums(xdate, y / trend_index, group, len(ids)))
+    slope, intercept = linear_fit(state)
+    error = np.abs(trend_index * (slope[group] * xdate + intercept[group]) - y)
+    valid = ~np.isnan(error)
+    state['error_sum'] = np.bincount(group, weights=np.where(valid, error, 0), minlength=len(ids))
+    state['error_count'] = np.bincount(group, weights=valid, minlength=len(ids))
+    state.update({'CMA_Val': CMA_Val, 'CutoffDate': CutoffDate, 'Uncertainty': Uncertainty})
+    return state
+
+
+def score_arima(state, main_gdf):
+    """Score statistics with a fitted arima_state, adding the columns
+    timeseries_trend adds.  Each row costs O(1), however many rows the state
+    was fit from.
+
+    Arguments
+    ---------
+    state : dict
+        The model, see arima_state and load_arima_state.
+    main_gdf : a :class:`pandas.DataFrame`
+        The statistics to score, i.e. the latest dates output by CometTS.
+
+    Returns
+    -------
+    gdf3 : a :class:`pandas.DataFrame`
+        The scored rows, sorted by ID (in state order) and date.  Like
+        timeseries_trend, rows of IDs without a trend and of months not seen
+        before the cutoff are left out, as are IDs not in the state.
+    """
+    gdf3, group, xdate, month = sort_series(main_gdf, state['ID'])
+    y = gdf3['mean'].values.astype('float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        seasonal = state['seasonal_sum'] / state['seasonal_count']
+        error = state['Uncertainty'] * state['error_sum'] / state['error_count']
+    slope, intercept = linear_fit(state)
+    known = group >= 0
+    keep = known.copy()
+    keep[known] = (state['seasonal_rows'][group[known], month[known] - 1] > 0) & (state['n'][group[known]] > 0)
+    gdf3, group, xdate, month, y = gdf3[keep], group[keep], xdate[keep], month[keep], y[keep]
+
+    trend_index = seasonal[group, month - 1]
+    trend = slope[group] * xdate + intercept[group]
+    forecast = trend_index * trend
+    gdf3['xdate'] = xdate
+    gdf3['Month'] = month
+    gdf3['SeasonalTrend'] = trend_index
+    gdf3['Trend'] = trend
+    gdf3['SeasonalForecast'] = forecast
+    gdf3['SeasonalError_Pos'] = forecast + error[group]
+    gdf3['SeasonalError_Neg'] = forecast - error[group]
+    with np.errstate(invalid='ignore'):
+        anomaly = (y < gdf3['SeasonalError_Neg'].values) | (y > gdf3['SeasonalError_Pos'].values)
+    gdf3['Anomaly'] = np.where(anomaly, y, np.nan)
+    return gdf3
+
+
+def save_arima_state(state, path):
+    """Save an arima_state to a .npz file.  Polygon IDs that are not numbers
+    (an object array) are saved as fixed-width strings, as .npz files can
+    only hold object arrays by pickling them."""
+    ids = np.asarray(state['ID'])
+    if ids.dtype == object:
+        ids = np.asarray(ids.tolist())
+        if ids.dtype.kind not in 'biufU':
+            raise ValueError("Polygon IDs must be numbers or strings to save the ARIMA state")
+    np.savez(path, **dict(state, ID=ids))
+
+
+def load_arima_state(path):
+    """Load an arima_state saved by save_arima_state."""
+    with np.load(path) as f:
+        state = dict((key, f[key]) for key in f.files)
+    for key in ('CMA_Val', 'Uncertainty'):
+        state[key] = state[key].item()
+    state['CutoffDate'] = str(state['CutoffDate'])
+    return state
+
+
+def batch_trend(main_gdf, CMA_Val=3, CutoffDate="2017/08/31", Uncertainty=2, state=None):
+    """timeseries_trend for every polygon ID at once.  All IDs are fit together
+    from grouped arrays (see arima_state), without a loop or a merge per ID.
+
+    Arguments
+    ---------
+    main_gdf : a :class:`pandas.DataFrame`
+        The statistics output by CometTS, for any number of IDs.
+    CMA_Val, CutoffDate, Uncertainty :
+        See timeseries_trend.
+    state : dict
+        Optional. The arima_state of main_gdf, if it has already been fit.
+
+    Returns
+    -------
+    gdf_holder : a :class:`pandas.DataFrame`
+        The rows and columns timeseries_trend returns for each ID, IDs in order
+        of appearance and each sorted by date.  IDs without a trend are left out.
+    """
+    if state is None:
+        state = arima_state(main_gdf, CMA_Val, CutoffDate, Uncertainty)
+    gdf3 = score_arima(state, main_gdf)
+    # Number the rows of each ID as the merge in timeseries_trend does, by
+    # month in order of first appearance, then by date
+    group = pd.Index(state['ID']).get_indexer(gdf3['ID'])
+    key = group * 13 + gdf3['Month'].values
+    first = np.unique(key, return_index=True)[1][np.unique(key, return_inverse=True)[1]]
+    rank = np.empty(len(gdf3), dtype=np.int64)
+    rank[np.lexsort((np.arange(len(gdf3)), first))] = np.arange(len(gdf3))
+    starts = np.r_[0, np.nonzero(group[1:] != group[:-1])[0] + 1]
+    gdf3.index = rank - np.repeat(starts, np.diff(np.r_[starts, len(gdf3)]))
+    return gdf3
+
+
+def update_arima(state_path, CometTSOutputCSV, outname):
+    """Score new statistics (i.e. this month's CometTS output) with a model
+    saved by run_arima, without refitting or reading the earlier statistics.
+
+    Arguments
+    ---------
+    state_path : str
+        The model state saved by run_arima (state_path).
+    CometTSOutputCSV : str
+        The csv (or parquet) statistics to score. All dates must be after the
+        CutoffDate of the model, earlier rows would change the fit so need a
+        full run_arima.
+    outname : str
+        The output name and path for a csv of the scored rows.
+
+    Returns
+    -------
+    gdf3 : a :class:`pandas.DataFrame`
+        The scored rows, see score_arima.
+    """
+    state = load_arima_state(state_path)
+    main_gdf = read_stats(CometTSOutputCSV)
+    if pd.api.types.is_datetime64_any_dtype(main_gdf['date']):
+        main_gdf['date'] = main_gdf['date'].dt.strftime('%Y-%m-%d')
+    cutoff = datetime.datetime.strptime(state['CutoffDate'], '%Y/%m/%d')
+    if (pd.to_datetime(main_gdf['date']) <= cutoff).any():
+        raise ValueError("Statistics on or before the CutoffDate " + state['CutoffDate'] +
+                         " change the model, run run_arima on all statistics instead")
+    gdf3 = score_arima(state, main_gdf)
+    gdf3.to_csv(outname)
+    return gdf3
+
+
+def cutoff_sweep(main_gdf, CutoffDates, CMA_Val=3, Uncertainty=2):
+    """Fit the timeseries_trend model of every polygon ID for many candidate
+    CutoffDates in one call, i.e. to find the date of an unknown event.
+
+    The series are sorted once and cumulative sums are taken per ID and month,
+    so the seasonal indices and trend of each extra cutoff come from prefix
+    sums instead of a refit.  The error band and anomaly counts take one
+    vectorized pass over the rows per cutoff.
+
+    Arguments
+    ---------
+    main_gdf : a :class:`pandas.DataFrame`
+        The statistics output by CometTS, for any number of IDs.
+    CutoffDates : list
+        The candidate CutoffDate strings, format YYYY/MM/DD.
+    CMA_Val, Uncertainty :
+        See timeseries_trend.
+
+    Returns
+    -------
+    sweep : a :class:`pandas.DataFrame`
+        One row per cutoff and ID with a trend: 'ID', 'CutoffDate', the number
+        of 'Anomalies' run_arima would flag, how many of them are after the
+        cutoff ('Anomalies_After') and the 'Error' band half width.
+    """
+    ids = pd.unique(main_gdf['ID'])
+    gdf3, group, xdate, month = sort_series(main_gdf, ids)
+    y = gdf3['mean'].values.astype('float64')
+    ngroups = len(ids)
+    lag = (CMA_Val - 1) // 2
+    # Rows of the centered moving average only depend on rows up to lag later,
+    # so a prefix of the full series average is the average of the prefix
+    div = y / grouped_centered_mean(y, group, CMA_Val)
+
+    # Cumulative sums in (ID, month, date) order, searched by a combined key
+    span = xdate.max() - xdate.min() + 2 if len(xdate) else 1
+    season = group * 12 + month - 1
+    order = np.lexsort((xdate, season))
+    key = season[order] * span + (xdate[order] - xdate.min())
+    starts = np.searchsorted(key, np.arange(ngroups * 12) * span)
+    x0 = np.zeros(ngroups)
+    x0[group[::-1]] = xdate[::-1]
+    x = xdate - x0[group]
+    valid_y = np.isfinite(y)
+    valid_div = ~np.isnan(div)
+    cumulative = {}
+    for name, values in [('div', np.where(valid_div, div, 0)), ('div_count', valid_div),
+                         ('rows', np.ones(len(y))), ('n', valid_y),
+                         ('sx', np.where(valid_y, x, 0)), ('sxx', np.where(valid_y, x * x, 0)),
+                         ('sy', np.where(valid_y, y, 0)), ('sxy', np.where(valid_y, x * y, 0))]:
+        cumulative[name] = np.r_[0, np.cumsum(values[order])]
+    group_key = group * span + (xdate - xdate.min())
+    group_starts = np.searchsorted(group_key, np.arange(ngroups) * span)
+    segments = np.arange(ngroups * 12)
+
+    def prefix(name, ends):
+        return (cumulative[name][ends] - cumulative[name][starts]).reshape(ngroups, 12)
+
+    results = []
+    for CutoffDate in CutoffDates:
+        xcutoff = mdates.date2num(datetime.datetime.strptime(CutoffDate, '%Y/%m/%d').date()) - xdate.min()
+        # Offsets within a segment lie in [0, span - 2]; keep the search inside it
+        xsearch = np.clip(xcutoff, -1, span - 1)
+        ends = np.searchsorted(key, segments * span + xsearch, side='right')
+        # The last lag rows before the cutoff have no complete moving average
+        count = np.searchsorted(group_key, np.arange(ngroups) * span + xsearch, side='right') - group_starts
+        last = np.where(count > lag, group_starts + count - lag - 1, -1)
+        xlast = np.where(last >= 0, xdate[np.maximum(last, 0)] - xdate.min(), -1)
+        div_ends = np.maximum(np.searchsorted(key, segments * span + np.repeat(xlast, 12), side='right'), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            seasonal = prefix('div', div_ends) / prefix('div_count', div_ends)
+            inverse = 1 / seasonal
+        seen = prefix('rows', ends) > 0
+        fit = np.isfinite(inverse) & (inverse != 0)
+        inverse = np.where(fit, inverse, 0)
+        n = (prefix('n', ends) * fit).sum(axis=1)
+        sums = {'x0': x0, 'n': n, 'sx': (prefix('sx', ends) * fit).sum(axis=1),
+                'sxx': (prefix('sxx', ends) * fit).sum(axis=1),
+                'sy': (prefix('sy', ends) * inverse).sum(axis=1),
+                'sxy': (prefix('sxy', ends) * inverse).sum(axis=1)}
+        slope, intercept = linear_fit(sums)
+
+        before = xdate - xdate.min() <= xcutoff
+        forecast = seasonal[group, month - 1] * (slope[group] * xdate + intercept[group])
+        error = Uncertainty * grouped_mean(np.where(before, np.abs(forecast - y), np.nan), group, ngroups)
+        keep = seen[group, month - 1] & (n[group] > 0)
+        with np.errstate(invalid='ignore'):
+            anomaly = keep & ((y < forecast - error[group]) | (y > forecast + error[group]))
+        has_trend = n > 0
+        results.append(pd.DataFrame({
+            'ID': ids[has_trend], 'CutoffDate': CutoffDate,
+            'Anomalies': np.bincount(group, weights=anomaly, minlength=ngroups)[has_trend].astype(int),
+            'Anomalies_After': np.bincount(group, weights=anomaly & ~before,
+                                           minlength=ngroups)[has_trend].astype(int),
+            'Error': error[has_trend]}))
+    return pd.concat(results, ignore_index=True)
+
+
+def sweep_arima(CometTSOutputCSV, outname, CutoffDates, CMA_Val=3, Uncertainty=2):
+    """Run cutoff_sweep on the output of CometTS.
+
+    Arguments
+    ---------
+    CometTSOutputCSV : str
+        The csv (or parquet) statistics output by CometTS.
+    outname : str
+        The output name and path for a csv of the anomaly counts and error of
+        each ID for each cutoff.
+    CutoffDates : list
+        The candidate CutoffDate strings, format YYYY/MM/DD.
+    CMA_Val, Uncertainty :
+        See timeseries_trend.
+
+    Returns
+    -------
+    sweep : a :class:`pandas.DataFrame`
+        See cutoff_sweep.
+    """
+    main_gdf = read_stats(CometTSOutputCSV, columns=['ID', 'date', 'mean'])
+    sweep = cutoff_sweep(main_gdf, CutoffDates, CMA_Val, Uncertainty)
+    sweep.to_csv(outname)
+    return sweep
+
+
+# Candidate (order, seasonal_order) pairs for sarima_trend, the one with the
+# lowest AIC is kept for each ID.  The last also fits series of just over a year.
+SARIMA_ORDERS = [((1, 0, 0), (0, 1, 1, 12)),
+                 ((0, 1, 1), (0, 1, 1, 12)),
+                 ((1, 1, 1), (0, 1, 1, 12)),
+                 ((1, 0, 0), (1, 0, 0, 12))]
+
+
+def sarima_model(train, order, seasonal_order):
+    """A statsmodels SARIMAX model, with a constant if it is not differenced."""
+    from statsmodels.tsa.statespace.sarimax import SARIMAX
+    differenced = order[1] + seasonal_order[1] > 0
+    return SARIMAX(train, order=tuple(order), seasonal_order=tuple(seasonal_order),
+                   trend='n' if differenced else 'c')
+
+
+def monthly_series(gdf3):
+    """The mean of each calendar month of a series, NaN for months without
+    valid data, over a continuous monthly index."""
+    y = pd.Series(gdf3['mean'].values.astype('float64'), index=pd.DatetimeIndex(pd.to_datetime(gdf3['date'])))
+    return y.replace([np.inf, -np.inf], np.nan).resample('MS').mean()
+
+
+def sarima_trend(gdf3, CutoffDate="2017/08/31", Uncertainty=2, orders=SARIMA_ORDERS, cache_dir=None):
+    """A seasonal ARIMA alternative to timeseries_trend for a single ID, fit
+    with statsmodels to the monthly means before CutoffDate.  Rows up to the
+    cutoff get one step ahead predictions, later rows the forecast from the
+    cutoff on.
+
+    Arguments
+    ---------
+    gdf3 : a :class:`pandas.DataFrame`
+        The statistics output by CometTS for one polygon ID.
+    CutoffDate, Uncertainty :
+        See timeseries_trend.
+    orders : list
+        Candidate (order, seasonal_order) pairs, the one with the lowest AIC is
+        used.  Defaults to SARIMA_ORDERS.
+    cache_dir : str
+        Optional. A directory caching the order and parameters fit for each ID,
+        keyed by a hash of the data before the cutoff.  Unchanged data reuses
+        them without fitting, new data starts the fit from them.
+
+    Returns
+    -------
+    gdf3 : a :class:`pandas.DataFrame`
+        gdf3 sorted by date with the columns timeseries_trend adds.  'Trend' is
+        the 12 month moving average of the forecast and 'SeasonalTrend' the
+        ratio of the forecast to it.  None if no model could be fit.
+    """
+    import warnings
+
+    gdf3 = gdf3.sort_values(['date']).reset_index(drop=True)
+    dates = pd.DatetimeIndex(pd.to_datetime(gdf3['date']))
+    cutoff = pd.Timestamp(datetime.datetime.strptime(CutoffDate, '%Y/%m/%d'))
+    before = dates <= cutoff
+    train = monthly_series(gdf3[before])
+    if train.count() < 3:
+        return None
+
+    entry, path = None, None
+    data_hash = hashlib.sha1(json.dumps([str(train.index[0]), train.tolist(), [[list(order), list(seasonal)] for order, seasonal in orders]]).encode()).hexdigest()
+    if cache_dir:
+        path = os.path.join(cache_dir, 'sarima_' + hashlib.sha1(str(gdf3['ID'].iloc[0]).encode()).hexdigest() + '.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                entry = json.load(f)
+
+    result = None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if entry is not None:
+            model = sarima_model(train, entry['order'], entry['seasonal_order'])
+            if entry['hash'] == data_hash:
+                result = model.smooth(entry['params'])
+            else:
+                try:
+                    result = model.fit(start_params=entry['params'], disp=False)
+                except (ValueError, IndexError, np.linalg.LinAlgError):
+                    result = None
+        if result is None:
+            for order, seasonal_order in orders:
+                # Differencing and lags need more months than the series has
+                lags = max(order[0] + seasonal_order[0] * seasonal_order[3], order[2] + seasonal_order[2] * seasonal_order[3])
+                if len(train) <= order[1] + seasonal_order[1] * seasonal_order[3] + lags:
+                    continue
+                try:
+                    fit = sarima_model(train, order, seasonal_order).fit(disp=False)
+                except (ValueError, IndexError, np.linalg.LinAlgError):
+                    continue
+                if np.isfinite(fit.aic) and (result is None or fit.aic < result.aic):
+                    result = fit
+    if result is None:
+        return None
+
+    if path and (entry is None or entry['hash'] != data_hash):
+        entry = {'hash': data_hash, 'order': list(result.model.order),
+                 'seasonal_order': list(result.model.seasonal_order),
+                 'params': [float(param) for param in result.params]}
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another worker of batch_sarima made it first
+                if not os.path.isdir(cache_dir):
+                    raise
+        tmp = path + '.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        replace_file(tmp, path)
+
+    months = dates.to_period('M')
+    end = (months.max() - train.index[-1].to_period('M')).n
+    prediction = result.predict(start=0, end=len(train) + max(end, 0) - 1)
+    prediction.index = prediction.index.to_period('M')
+    # Predictions are uninformed until the differencing has data to work on
+    prediction.iloc[:result.model.order[1] + result.model.seasonal_order[1] * result.model.seasonal_order[3]] = np.nan
+    trend = prediction.rolling(12, center=True, min_periods=1).mean()
+
+    y = gdf3['mean'].values.astype('float64')
+    forecast = prediction.reindex(months).values
+    gdf3['xdate'] = mdates.date2num(dates.to_pydatetime())
+    gdf3['Month'] = dates.month
+    gdf3['Trend'] = trend.reindex(months).values
+    gdf3['SeasonalTrend'] = forecast / gdf3['Trend'].values
+    gdf3['SeasonalForecast'] = forecast
+    Error = Uncertainty * np.nanmean(np.abs(forecast[before] - y[before]))
+    gdf3['SeasonalError_Pos'] = forecast + Error
+    gdf3['SeasonalError_Neg'] = forecast - Error
+    with np.errstate(invalid='ignore'):
+        anomaly = (y < forecast - Error) | (y > forecast + Error)
+    gdf3['Anomaly'] = np.where(anomaly, y, np.nan)
+    return gdf3
+
+
+def _pool_sarima_trend(args):
+    return sarima_trend(*args)
+
+
+def batch_sarima(main_gdf, CutoffDate="2017/08/31", Uncertainty=2, orders=SARIMA_ORDERS, cache_dir=None,
+                 workers=1):
+    """sarima_trend for every polygon ID, fit in a pool of worker processes.
+
+    Arguments
+    ---------
+    main_gdf : a :class:`pandas.DataFrame`
+        The statistics output by CometTS, for any number of IDs.
+    workers : int
+        The number of processes fitting IDs in parallel.
+    (all others)
+        See sarima_trend.
+
+    Returns
+    -------
+    gdf_holder : a :class:`pandas.DataFrame`
+        The rows and columns sarima_trend returns for each ID, IDs in order
+        of appearance.  IDs without a model are left out.
+    """
+    check_bands(main_gdf)
+    tasks = [(gdf3, CutoffDate, Uncertainty, orders, cache_dir)
+             for _, gdf3 in main_gdf.groupby('ID', sort=False)]
+    if workers <= 1:
+        results = list(tqdm(map(_pool_sarima_trend, tasks), total=len(tasks)))
+    else:
+        pool = Pool(workers)
+        try:
+            results = list(tqdm(pool.imap(_pool_sarima_trend, tasks), total=len(tasks)))
+        finally:
+            pool.close()
+            pool.join()
+    results = [gdf3 for gdf3 in results if gdf3 is not None]
+    if not results:
+        return pd.DataFrame(columns=list(main_gdf.columns) + [
+            'xdate', 'Month', 'Trend', 'SeasonalTrend', 'SeasonalForecast', 'SeasonalError_Pos',
+            'SeasonalError_Neg', 'Anomaly'])
+    return pd.concat(results)
+
+
+def run_arima(CometTSOutputCSV="/San_Juan_FullStats.csv", outname="/FullStats_timeseries_trend.csv", CMA_Val=3, CutoffDate="2017/12/31", Uncertainty=2, state_path=None,
+              model='trend', workers=1, cache_dir=None):
     """Run an autoregressive integrated moving average analysis. And flag anomalies
     in the time series.
 
     Arguments
     ---------
     CometTSOutputCSV : str
-        The specific path to the csv that was output from running CometTS with
-        all detailed statistics for each polygon of interest.
+        The specific path to the csv (or parquet) that was output from running
+        CometTS with all detailed statistics for each polygon of interest.
     outname : str
         The output name and path for a csv documenting your ARIMA analysis.
     CMA_Val : int
@@ -114,6 +837,17 @@ def run_arima(CometTSOutputCSV="/San_Juan_FullStats.csv", outname="/FullStats_ti
         forecast, for shorter time series a greater uncertainty value is
         likely required so anomalies are not overly flagged.  For long time
         series set equal to 1. User discretion advised.
+    state_path : str
+        Optional. Save the fitted model to this .npz file, so statistics of
+        later dates can be scored with update_arima without refitting.
+    model : str
+        'trend' (default) fits the seasonal index and linear trend of
+        timeseries_trend.  'sarima' fits a seasonal ARIMA model to each ID
+        instead, see sarima_trend.  Requires statsmodels.
+    workers : int
+        The number of processes fitting 'sarima' models in parallel.
+    cache_dir : str
+        Optional. A directory caching the fitted 'sarima' models.
 
     Returns
     -------
@@ -121,20 +855,22 @@ def run_arima(CometTSOutputCSV="/San_Juan_FullStats.csv", outname="/FullStats_ti
     """
 
     print("Calculating...")
-    C = 0
-    main_gdf = pd.read_csv(CometTSOutputCSV)
-    for item in tqdm(main_gdf['ID'].unique()):
-        C += 1
-        gdf3 = main_gdf[(main_gdf.ID == item)]
-        gdf3 = gdf3.sort_values(['date'])
-        gdf3 = timeseries_trend(gdf3, CMA_Val=CMA_Val, CutoffDate=CutoffDate, Uncertainty=Uncertainty)
-        gdf3 = gdf3.sort_values(['date'])
-        if 'SeasonalForecast' in gdf3.columns:
-            if C == 1:
-                gdf_holder = gdf3
-            else:
-                gdf_holder = gdf_holder.append(gdf3)
-
+    main_gdf = read_stats(CometTSOutputCSV)
+    if pd.api.types.is_datetime64_any_dtype(main_gdf['date']):
+        # Parquet stores typed dates, the output keeps them as date strings
+        main_gdf['date'] = main_gdf['date'].dt.strftime('%Y-%m-%d')
+    if model == 'sarima':
+        if state_path:
+            raise ValueError("A model state can only be saved for the 'trend' model")
+        gdf_holder = batch_sarima(main_gdf, CutoffDate, Uncertainty, cache_dir=cache_dir, workers=workers)
+        gdf_holder.to_csv(outname)
+        return
+    if model != 'trend':
+        raise ValueError("model must be 'trend' or 'sarima', not " + repr(model))
+    state = arima_state(main_gdf, CMA_Val=CMA_Val, CutoffDate=CutoffDate, Uncertainty=Uncertainty)
+    if state_path:
+        save_arima_state(state, state_path)
+    gdf_holder = batch_trend(main_gdf, state=state)
     gdf_holder.to_csv(outname)
 
 ###############################################################################
@@ -150,18 +886,44 @@ def main():
 
     # general settings
     parser.add_argument('--CometTSOutputCSV', type=str, default=List,
-                        help="Enter CSV output from CometTS script, as input for ARIMA, default: " + List)
+                        help="Enter CSV (or parquet) output from CometTS script, as input for ARIMA, default: " + List)
     parser.add_argument('--ARIMA_CSV', type=str, default=ARIMA,
                         help="Enter ARIMA CSV output name: " + ARIMA)
     parser.add_argument('--CMA_Val', type=int, default=3,
                         help="Default is 3. Centered Moving Average Value for ARIMA, set to an odd number >=3")
     parser.add_argument('--CutoffDate', type=str, default="2017/08/15",
                         help="Default is 2017/08/15. Format YYYY/MM/DD. Split data into a before and after event, i.e. a Hurricane. If no event simply set as last date in dataset, or a middle date. Ensure you have at least 14 observations of data to pull out an historical trend")
+    parser.add_argument('--cube', type=str, default=None,
+                        help="Optional CometTS data cube directory. Writes per pixel trend and anomaly GeoTIFFs to --maps_out instead of running on the CSV.")
+    parser.add_argument('--maps_out', type=str, default="",
+                        help="Output directory for per pixel maps, defaults to the cube directory.")
+    parser.add_argument('--state', type=str, default=None,
+                        help="Optional .npz model state. Saved when running ARIMA, read when scoring --update.")
+    parser.add_argument('--update', type=str, default=None,
+                        help="Score this CometTS output (dates after CutoffDate) with the saved --state, without refitting.")
+    parser.add_argument('--sweep', type=str, default=None,
+                        help="Optional comma separated CutoffDates, format YYYY/MM/DD. Writes the anomaly count and error of each ID for each cutoff to ARIMA_CSV instead.")
+    parser.add_argument('--model', type=str, default='trend', choices=['trend', 'sarima'],
+                        help="Default is trend, a seasonal index and linear trend. sarima fits a seasonal ARIMA model per ID, requires statsmodels.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Default is 1. Number of processes fitting sarima models in parallel.")
+    parser.add_argument('--sarima_cache', type=str, default=None,
+                        help="Optional directory caching the fitted sarima orders and parameters of each ID, so re-runs only refit IDs with new data.")
     parser.add_argument('--Uncertainty', type=int, default=2,
                         help="Default is 2. Multiplier for the mean absolute error from the ARIMA forecast, for shorter time series a greater uncertainty value is likely required so anomalies are not overly flagged.  For long time series set equal to 1. User discretion advised.")
     args = parser.parse_args()
 
-    run_arima(args.CometTSOutputCSV, args.ARIMA_CSV, args.CMA_Val, args.CutoffDate, args.Uncertainty)
+    if args.cube:
+        write_trend_maps(args.cube, args.maps_out or args.cube, args.CMA_Val, args.CutoffDate, args.Uncertainty)
+        return
+    if args.sweep:
+        sweep_arima(args.CometTSOutputCSV, args.ARIMA_CSV, args.sweep.split(','), args.CMA_Val, args.Uncertainty)
+        return
+    if args.update:
+        update_arima(args.state, args.update, args.ARIMA_CSV)
+        return
+    run_arima(args.CometTSOutputCSV, args.ARIMA_CSV, args.CMA_Val, args.CutoffDate, args.Uncertainty, args.state,
+              args.model, args.workers, args.sarima_cache)
     print("Run ARIMA_Plotting.ipynb to generate visualizations from output CSV")
 
 
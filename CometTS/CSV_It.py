@@ -1,20 +1,122 @@
 import os
 import glob
+import json
 import pandas as pd
 import geopandas as gpd
 from tqdm import tqdm as tqdm
 from fnmatch import fnmatch
-from CometTS.CometTS import get_extent
+from multiprocessing.pool import ThreadPool
+from CometTS.CometTS import get_raster_info, file_signature, write_catalog, replace_file, RASTER_INFO
 import argparse
 
 
+def list_subdirs(input_dir):
+    """The subdirectories of input_dir, as 'name/', in glob order."""
+    prefix = os.path.join(glob.escape(input_dir), '')
+    return [path[len(prefix):] for path in glob.glob(prefix + '*/')]
+
+
+def match_files(input_dir, directory, pattern):
+    """The names of the files in a subdirectory matching a glob pattern,
+    without changing the working directory."""
+    return [os.path.basename(path) for path in
+            glob.glob(os.path.join(glob.escape(os.path.join(input_dir, directory)), pattern))]
+
+
+def catalog_info(paths, workers=8, cache=None):
+    """get_raster_info for many rasters, reading the headers in a pool of threads.
+
+    Arguments
+    ---------
+    paths : list
+        The rasters to read the header of.
+    workers : int
+        The number of headers read at once, i.e. to hide network storage latency.
+    cache : str
+        Optional. A JSON file keeping the header of every raster by its path,
+        size and modification time.  Only new or changed rasters are read,
+        and the cache is updated with them.
+
+    Returns
+    -------
+    info : list
+        The header of each raster, see get_raster_info, in the same order as paths.
+    """
+    cached = {}
+    if cache and os.path.exists(cache):
+        with open(cache) as f:
+            cached = json.load(f)
+    signatures = [file_signature(path) for path in paths]
+    missing = sorted(set(path for path, signature in zip(paths, signatures)
+                         if cached.get(signature[0], [None])[:2] != signature[1:]
+                         or not isinstance(cached[signature[0]][2], dict)))
+    if missing:
+        pool = ThreadPool(max(1, workers))
+        try:
+            info = list(tqdm(pool.imap(get_raster_info, missing), total=len(missing)))
+        finally:
+            pool.close()
+            pool.join()
+        for path, header in zip(missing, info):
+            signature = file_signature(path)
+            cached[signature[0]] = signature[1:] + [header]
+        if cache:
+            tmp = cache + '.' + str(os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(cached, f)
+            replace_file(tmp, cache)
+    return [cached[signature[0]][2] for signature in signatures]
+
+
+def finish_catalog(rasterList, workers=8, cache=None, catalog=None, headers=None):
+    """Complete the rows listed by csv_it or ls_csv_it with the header of each
+    raster and parse their dates, all at once.  headers optionally gives, for
+    each row, the raster to read the header from, i.e. one band of a scene
+    for all bands on its grid.
+
+    Returns
+    -------
+    gdf : a :class:`geopandas.geodataframe`
+        The catalog, with the extent and typed columns (RASTER_INFO) of each
+        raster and datetime64 dates.  Also written to catalog if it is given,
+        see write_catalog.
+    """
+    if headers is None:
+        headers = [row['File'] for row in rasterList]
+    info = catalog_info(headers, workers, cache)
+    for row, header in zip(rasterList, info):
+        row['extent'] = header['extent']
+    gdf = gpd.GeoDataFrame(rasterList)
+    if len(gdf):
+        gdf['date'] = pd.to_datetime(gdf['date'], infer_datetime_format=True)
+        for column in RASTER_INFO:
+            gdf[column] = [header[column] for header in info]
+    if catalog:
+        write_catalog(gdf, catalog)
+    return gdf
+
+
+# The file name of each Landsat band, by sensor
+LANDSAT_BANDS = {
+    'COASTAL': {'LC08': 'band1'},
+    'BLUE': {'LE07': 'band1', 'LT05': 'band1', 'LC08': 'band2'},
+    'GREEN': {'LE07': 'band2', 'LT05': 'band2', 'LC08': 'band3'},
+    'RED': {'LE07': 'band3', 'LT05': 'band3', 'LC08': 'band4'},
+    'NIR': {'LE07': 'band4', 'LT05': 'band4', 'LC08': 'band5'},
+    'SWIR1': {'LE07': 'band5', 'LT05': 'band5', 'LC08': 'band6'},
+    'SWIR2': {'LE07': 'band7', 'LT05': 'band7', 'LC08': 'band7'}}
+
+
 def csv_it(
         input_dir="./VIIRS_Sample",
         TSdata="S*rade9.tif",
         Observations="",
         Mask="",
         DateLoc="10:18",
-        BandNum=""):
+        BandNum="",
+        workers=8,
+        cache=None,
+        catalog=None):
     """Document and index your time series of raster imagery, masks, and potentially
     observation data.
 
@@ -43,12 +145,21 @@ def csv_it(
         If there are multiple bands in the dataset and you are only interested
         in a specific one that is stored in a filename, pass that string or value
         here.
+    workers : int
+        The number of raster headers read at once.  Defaults to 8.
+    cache : str
+        Optional. A JSON file caching the header of each raster, so cataloguing
+        again only reads new or changed files.  See catalog_info.
+    catalog : str
+        Optional. Also write the catalog to this indexed SQLite database, which
+        run_comet can query by date, region and band.  See write_catalog.
 
     Returns
     -------
     gdf : a :class:`geopandas.geodataframe` that contains the fully documented
     directory structure of all of your timeseries data as well as any ancilary
-    files of interest.  Also outputs a CSV documenting all of this.
+    files of interest, with the bounds, CRS, size, dtype, block size and nodata
+    of each raster.  Also outputs a CSV documenting all of this.
     """
     # Ensuring the user entered everything properly
     input_dir = input_dir.strip()
@@ -84,17 +195,15 @@ def csv_it(
     else:
         print("No mask band entered")
 
-    os.chdir(input_dir)
     # Identify all subdirs that contain our raster data
-    input_subdirs = glob.glob('*/')
+    input_subdirs = list_subdirs(input_dir)
     print(len(input_subdirs))
 
     rasterList = []
     DateLoc = DateLoc.split(":")
     for directory in tqdm(input_subdirs):
-        os.chdir(directory)
         # Find our primary rasters of interest
-        FilePattern = glob.glob(TSdata)
+        FilePattern = match_files(input_dir, directory, TSdata)
         if len(Observations) > 0:
             Observations = [Observations]
             FilePattern = [x for x in FilePattern if not any(
@@ -103,44 +212,39 @@ def csv_it(
         for raster in FilePattern:
             statout = [{}]
             statout[0]['File'] = input_dir + '/' + directory + '/' + raster
-            rasterExtent = get_extent(raster)
-            statout[0]['extent'] = rasterExtent
+            statout[0]['extent'] = None
             date = raster[int(DateLoc[0]):int(DateLoc[1])]
-            statout[0]['date'] = pd.to_datetime(
-                date, infer_datetime_format=True)
+            statout[0]['date'] = date
             statout[0]['obs'] = 0
             statout[0]['TS_Data'] = 1
             if len(BandNum) > 0:
                 BandNum = raster[int(BandNum[0]):int(BandNum[1])]
                 statout[0]['band_num'] = BandNum
             if len(Mask) > 0:
-                mask = glob.glob(Mask)[0]
+                mask = match_files(input_dir, directory, Mask)[0]
                 statout[0]['Mask'] = input_dir + '/' + directory + '/' + mask
             rasterList.append(statout[0])
 
         if len(Observations) > 0:
-            FilePattern = glob.glob(Observations)
+            FilePattern = match_files(input_dir, directory, Observations)
             for raster in FilePattern:
                 statout = [{}]
                 statout[0]['File'] = input_dir + '/' + directory + '/' + raster
-                rasterExtent = get_extent(raster)
-                statout[0]['extent'] = rasterExtent
+                statout[0]['extent'] = None
                 date = raster[int(DateLoc[0]):int(DateLoc[1])]
-                statout[0]['date'] = pd.to_datetime(
-                    date, infer_datetime_format=True)
+                statout[0]['date'] = date
                 statout[0]['obs'] = 1
                 statout[0]['TS_Data'] = 0
                 if len(BandNum) > 0:
                     statout[0]['band_num'] = 0
                 if len(Mask) > 0:
-                    mask = glob.glob(Mask)[0]
+                    mask = match_files(input_dir, directory, Mask)[0]
                     statout[0]['Mask'] = input_dir + \
                         '/' + directory + '/' + mask
                 rasterList.append(statout[0])
 
-        os.chdir(input_dir)
-
-    gdf = gpd.GeoDataFrame(rasterList)
+    # Read the raster headers at once, from the cache where possible
+    gdf = finish_catalog(rasterList, workers, cache, catalog)
     return gdf
 
 
@@ -149,7 +253,10 @@ def ls_csv_it(
         TSdata="L*.tif",
         Mask="",
         DateLoc="10:18",
-        Band="BLUE"):
+        Band="BLUE",
+        workers=8,
+        cache=None,
+        catalog=None):
     """Document and index your time series of raster imagery, and masks. Used
     specifically for Landsat imagery.
 
@@ -170,15 +277,21 @@ def ls_csv_it(
         information is stored in each filename string.  Typical python index
         format.
     Band : str
-        Which band of interest you are intersted in plotting.  If interested in
-        plotting multiple bands at once, this function must be run interatively.
-        Options are: COASTAL, BLUE, GREEN, RED, NIR, SWIR1, SWIR2
+        Which band of interest you are intersted in plotting.  Options are:
+        COASTAL, BLUE, GREEN, RED, NIR, SWIR1, SWIR2.  Several bands can be
+        split by commas (i.e. RED,NIR), or use ALL for every band.  Each
+        directory is listed once and every file is classified into its band
+        (the 'band_num' column), by sensor, with LANDSAT_BANDS.  With several
+        bands the header of one band is read for all bands of a scene.
+    workers, cache, catalog :
+        See csv_it.
 
     Returns
     -------
     gdf : a :class:`geopandas.geodataframe` that contains the fully documented
     directory structure of all of your timeseries data as well as any ancilary
-    files of interest.  Also outputs a CSV documenting all of this.
+    files of interest, with the bounds, CRS, size, dtype, block size and nodata
+    of each raster.  Also outputs a CSV documenting all of this.
     """
     # Ensuring the user entered everything properly
     input_dir = input_dir.strip()
@@ -200,62 +313,61 @@ def ls_csv_it(
 
     if len(Band) > 0:
         print("Band of interest:", Band)
-        if Band == "COASTAL":
-            TSdata = ["LC08*band1.tif"]
-        if Band == "BLUE":
-            TSdata = ['LE07*band1.tif', 'LT05*band1.tif', 'LC08*band2.tif']
-        if Band == "GREEN":
-            TSdata = ['LE07*band2.tif', 'LT05*band2.tif', 'LC08*band3.tif']
-        if Band == "RED":
-            TSdata = ['LE07*band3.tif', 'LT05*band3.tif', 'LC08*band4.tif']
-        if Band == "NIR":
-            TSdata = ['LE07*band4.tif', 'LT05*band4.tif', 'LC08*band5.tif']
-        if Band == "SWIR1":
-            TSdata = ['LE07*band5.tif', 'LT05*band5.tif', 'LC08*band6.tif']
-        if Band == "SWIR2":
-            TSdata = ['LE07*band7.tif', 'LT05*band7.tif', 'LC08*band7.tif']
+        bands = list(LANDSAT_BANDS) if Band == "ALL" else [item.strip() for item in Band.split(",")]
+        for item in bands:
+            if item not in LANDSAT_BANDS:
+                raise ValueError("Unknown band " + item + ", options are: " + ", ".join(LANDSAT_BANDS) + ", ALL")
+        # (pattern, band) pairs to sort the files of each directory with
+        TSdata = [(sensor + '*' + name + '.tif', item) for item in bands
+                  for sensor, name in LANDSAT_BANDS[item].items()]
     else:
         print("No band entered, this is recommended for Landsat, unless you are working with an index like NDVI")
         print("Options are: COASTAL, BLUE, GREEN, RED, NIR, SWIR1, SWIR2")
-        TSdata = [TSdata]
+        bands = []
+        TSdata = [(TSdata, None)]
 
     if len(Mask) > 0:
         print("Mask band pattern:", Mask)
     else:
         print("No mask band entered")
 
-    os.chdir(input_dir)
     # Identify all subdirs that contain our raster data
-    input_subdirs = glob.glob('*/')
+    input_subdirs = list_subdirs(input_dir)
     print(len(input_subdirs))
 
     rasterList = []
+    headers = []
     DateLoc = DateLoc.split(":")
 
     for directory in tqdm(input_subdirs):
-        os.chdir(directory)
-        # Find our primary rasters of interest
+        # List the directory once and sort its files into bands
+        files = match_files(input_dir, directory, '*')
+        if len(Mask) > 0:
+            masks = [raster for raster in files if fnmatch(raster, Mask)]
         FilePattern = []
-        for item in TSdata:
-            FilePattern.extend(glob.glob(item))
-        for raster in FilePattern:
+        for pattern, item in TSdata:
+            FilePattern.extend((raster, item) for raster in files if fnmatch(raster, pattern))
+        scenes = {}
+        for raster, item in FilePattern:
             statout = [{}]
             statout[0]['File'] = input_dir + '/' + directory + '/' + raster
-            rasterExtent = get_extent(raster)
-            statout[0]['extent'] = rasterExtent
+            statout[0]['extent'] = None
             date = raster[int(DateLoc[0]):int(DateLoc[1])]
-            statout[0]['date'] = pd.to_datetime(
-                date, infer_datetime_format=True)
+            statout[0]['date'] = date
             statout[0]['obs'] = 0
             statout[0]['TS_Data'] = 1
+            if item is not None:
+                statout[0]['band_num'] = item
             if len(Mask) > 0:
-                mask = glob.glob(Mask)[0]
+                mask = masks[0]
                 statout[0]['Mask'] = input_dir + '/' + directory + '/' + mask
             rasterList.append(statout[0])
+            # The bands of a scene share its grid, read one header for all
+            scene = scenes.setdefault((raster[:4], date), statout[0]['File'])
+            headers.append(scene if len(bands) > 1 else statout[0]['File'])
 
-        os.chdir(input_dir)
-
-    gdf = gpd.GeoDataFrame(rasterList)
+    # Read the raster headers at once, from the cache where possible
+    gdf = finish_catalog(rasterList, workers, cache, catalog, headers)
     return gdf
 
 
@@ -281,10 +393,17 @@ def main():
                         help="The location of the band number or name in your file.  This will be extracted using regex techniques. ")
     parser.add_argument('--output_dir', type=str, default=directory,
                         help="Default is same as input_dir. ")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="Default is 8. Number of raster headers to read at once.")
+    parser.add_argument('--cache', type=str, default=None,
+                        help="Optional JSON file caching raster headers by path, size and modification time, so re-runs only read new or changed files.")
+    parser.add_argument('--catalog', type=str, default=None,
+                        help="Optional. Also write an indexed SQLite catalog (i.e. Raster_List.sqlite), queryable by date, region and band in CometTS.")
 
     args = parser.parse_args()
     gdf_out = csv_it(input_dir=args.input_dir, TSdata=args.TSdata, Observations=args.Observations,
-                     Mask=args.Mask, DateLoc=args.DateLoc, BandNum=args.BandNum)
+                     Mask=args.Mask, DateLoc=args.DateLoc, BandNum=args.BandNum, workers=args.workers,
+                     cache=args.cache, catalog=args.catalog)
     output = os.path.join(args.output_dir, 'Raster_List.csv')
     gdf_out.to_csv(output)
 
@@ -1,22 +1,77 @@
 import os
+import re
+import sys
+import ast
+import math
+import json
+import hashlib
+import sqlite3
+import threading
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import gdal
 import rasterio
-from rasterstats import zonal_stats
+from affine import Affine
+from rasterio.features import rasterize
+from rasterio.windows import Window
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+from shapely.geometry import box
+import shapely.wkt
 from tqdm import tqdm as tqdm
 import argparse
 
+STATS = "min max median mean std percentile_25 percentile_75 count"
 
-def run_comet(directory_csv, zonalpoly, NoDataValue, mask_value, maskit=True, Path_out=""):
+# The header fields csv_it keeps for every raster (see get_raster_info), and
+# their types in the SQLite catalog
+RASTER_INFO = ['minx', 'miny', 'maxx', 'maxy', 'crs', 'width', 'height', 'dtype', 'blockxsize',
+               'blockysize', 'nodata']
+CATALOG_TYPES = {'obs': 'INTEGER', 'TS_Data': 'INTEGER', 'minx': 'REAL', 'miny': 'REAL',
+                 'maxx': 'REAL', 'maxy': 'REAL', 'crs': 'TEXT', 'width': 'INTEGER',
+                 'height': 'INTEGER', 'dtype': 'TEXT', 'blockxsize': 'INTEGER',
+                 'blockysize': 'INTEGER', 'nodata': 'REAL'}
+
+# Spectral index presets for band_math, over the band names of ls_csv_it
+BAND_MATH_PRESETS = {'NDVI': '(NIR - RED) / (NIR + RED)',
+                     'NDBI': '(SWIR1 - NIR) / (SWIR1 + NIR)',
+                     'NDWI': '(GREEN - NIR) / (GREEN + NIR)'}
+
+# The (first bit, number of bits) of each flag of the Landsat surface
+# reflectance pixel_qa band, and the levels of its confidence flags
+QA_BITS = {'fill': (0, 1), 'clear': (1, 1), 'water': (2, 1), 'shadow': (3, 1), 'snow': (4, 1),
+           'cloud': (5, 1), 'cloud_confidence': (6, 2), 'cirrus_confidence': (8, 2),
+           'terrain': (10, 1)}
+QA_LEVELS = {'none': 0, 'low': 1, 'medium': 2, 'high': 3}
+# The numpy functions a band_math expression may call
+BAND_MATH_FUNCTIONS = {'abs': np.abs, 'sqrt': np.sqrt, 'log': np.log, 'log10': np.log10,
+                       'exp': np.exp, 'minimum': np.minimum, 'maximum': np.maximum,
+                       'where': np.where}
+# Numbers parse as ast.Num (value in n) before Python 3.8, and Python 2.7 has
+# no ast.Constant, so only look up the node type of this version
+if sys.version_info < (3, 8):
+    _BAND_MATH_NUMBERS, _BAND_MATH_NUMBER_FIELD = (ast.Num,), 'n'
+else:
+    _BAND_MATH_NUMBERS, _BAND_MATH_NUMBER_FIELD = (ast.Constant,), 'value'
+_BAND_MATH_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Name, ast.Load,
+                    ast.Call, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd,
+                    ast.Lt, ast.LtE, ast.Gt, ast.GtE) + _BAND_MATH_NUMBERS
+
+
+def run_comet(directory_csv, zonalpoly, NoDataValue, mask_value, maskit=True, Path_out="", workers=1,
+              cache_dir=None, backend='index', result_cache=None, output_format='csv', per_id='files',
+              stream=False, cube=None, start_date=None, end_date=None, bbox=None, band=None,
+              band_math=None):
     """Run CometTS.  Analyze your timeseries of raster data for your polygon(s) of interest.
 
     Arguments
     ---------
     directory_csv : str
         The specific path to the csv documenting your raster data and
-        directory structure created with CometTS.csv_it.
+        directory structure created with CometTS.csv_it, or the SQLite
+        catalog written with it (see write_catalog).
     zonalpoly : str
         The specific path to the polygon (geojson or shapefile or other vector)
         that contains your areas of interest for analysis.
@@ -28,7 +83,9 @@ def run_comet(directory_csv, zonalpoly, NoDataValue, mask_value, maskit=True, Pa
     mask_value : int(s)
         The value of a cloud or other anomaly mask (ex: Clouds/Cloud Shadow=1).
          Multiple values can be used and be split by commas (i.e. 1,2,99) if no
-          masking is required, leave blank.
+          masking is required, leave blank.  With a Landsat pixel_qa band as
+          the mask, QA bit rules can be used instead (i.e.
+          cloud,shadow,snow,cloud_confidence>=medium), see mask_lut.
     maskit : bool
         Should cloud or anomalies be masked? Defaults to yes (``True``). If true
         the function will use the mask_value(s) passed to automatically remove
@@ -37,6 +94,50 @@ def run_comet(directory_csv, zonalpoly, NoDataValue, mask_value, maskit=True, Pa
         The output path for detailed statistics of each polygon analyzed for the
         entire time series of imagery.  All stats will be stored in csv format.
         Defaults to the same path as directory_csv.
+    workers : int
+        The number of processes to spread the imagery across, split by date.
+        Defaults to 1 (no process pool). Output is identical for any value.
+    cache_dir : str
+        Optional. A directory to save the rasterized polygons of each raster
+        grid in, so repeat runs over the same polygons skip rasterizing.
+    backend : str
+        How polygon statistics are calculated, 'index' (default) or 'label'.
+        'label' is much faster for thousands of non-overlapping polygons.
+    result_cache : str
+        Optional. A directory to keep the statistics of every raster/polygon
+        pair in. Re-runs (i.e. after new imagery arrives) only calculate new or
+        changed pairs, and an interrupted run resumes where it stopped.
+    output_format : str
+        'csv' (default) or 'parquet'. Parquet files have typed columns and no
+        geometry, the polygons are written once to <zonalpoly>_Geometry.parquet.
+        Read either format with read_stats.
+    per_id : str
+        How the statistics of each polygon are saved on their own. 'files'
+        (default) writes <zonalpoly>_Stats_ID_<ID> files to Path_out, 'dataset'
+        writes them as <ID> files in a <zonalpoly>_Stats_ID directory, and
+        'none' skips them.
+    stream : bool
+        Write the FullStats output as the imagery is processed instead of
+        holding every result in memory (see stream_zonal_stats). Defaults to
+        ``False``. When ``True`` no per ID files are written and nothing is
+        returned.
+    cube : str
+        Optional. A data cube directory (see build_cube) to read the imagery
+        from, built from directory_csv first if it does not exist yet or was
+        built from another catalog, other polygons or settings (see
+        cube_settings). Not used when streaming.  A cube holds one band, so
+        multi-band catalogs need a band.
+    start_date, end_date, bbox, band :
+        Optional. Only process the imagery of a date range, region or band(s),
+        see read_catalog.  With an SQLite catalog only the matching rows are
+        read.  The bands of a multi-band catalog (see ls_csv_it) are processed
+        together, scene by scene, and output with a 'band' column.
+    band_math : list
+        Optional. Band math expressions over the band_num of a multi-band
+        catalog, i.e. ['NDVI', 'SR=NIR / RED'], see parse_band_math.  Each is
+        calculated in memory from the masked bands of every scene and output
+        in place of the bands, named in the 'band' column.  Not used with a
+        cube.
 
     Returns
     -------
@@ -50,31 +151,66 @@ def run_comet(directory_csv, zonalpoly, NoDataValue, mask_value, maskit=True, Pa
     if maskit:
         mask_value = str(mask_value)
         mask_value = mask_value.split(",")
+        # Check the mask values and QA bit rules before any imagery is read
+        mask_lut(mask_value)
     # Get the zonal stats
     NoDataValue = int(NoDataValue)
-    gdf2 = calculate_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit)
-    # Get number of observations
-    gdf3 = get_num_obs(directory_csv, gdf, NoDataValue, mask_value, maskit)
-    for date in gdf2.iterrows():
-        if 'median' in gdf3.columns:
-            gdf2['observations'] = gdf3['median']
-
-    # Save CSV
-    print("Producing csv output...")
     z_simple = zonalpoly.split('/')
     z_simple = z_simple[-1].split('.')
     z_simple = z_simple[0]
     if Path_out == "":
         Path_out = os.path.dirname(os.path.abspath(directory_csv))
+    query = None
+    if any(item is not None for item in (start_date, end_date, bbox, band)):
+        query = {'start_date': start_date, 'end_date': end_date,
+                 'bbox': [float(item) for item in bbox] if bbox is not None else None, 'band': band}
+    if band_math and cube:
+        raise ValueError("band_math is not available for a data cube")
+    geometry_table = None
+    if output_format == 'parquet':
+        geometry_table = z_simple + '_Geometry.parquet'
+        write_geometry_table(gdf, os.path.join(Path_out, geometry_table))
+
+    if stream:
+        # Write the stats and number of observations as they are calculated
+        output = os.path.join(Path_out, z_simple + '_FullStats.' + output_format)
+        stream_zonal_stats(directory_csv, gdf, output, NoDataValue, mask_value, maskit, workers,
+                           observations=True, cache_dir=cache_dir, backend=backend,
+                           result_cache=result_cache, geometry_table=geometry_table, query=query,
+                           band_math=band_math)
+        print("Statistics saved here: ", output)
+        return None
+
+    if cube:
+        # Read the stats and number of observations from the data cube
+        if not cube_is_current(cube, directory_csv, gdf, NoDataValue, mask_value, maskit, query):
+            build_cube(directory_csv, gdf, cube, NoDataValue, mask_value, maskit, query)
+        gdf2 = calculate_cube_stats(cube, gdf, NoDataValue, mask_value, maskit, backend=backend, query=query)
+    else:
+        # Get the zonal stats and number of observations in a single pass
+        gdf2 = calculate_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit, workers,
+                                     observations=True, cache_dir=cache_dir, backend=backend,
+                                     result_cache=result_cache, query=query, band_math=band_math)
+
+    # Save CSV
+    print("Producing " + output_format + " output...")
+    if output_format == 'parquet':
+        output = os.path.join(Path_out, z_simple + '_FullStats.parquet')
+        print("Parquet statistics saved here: ", output)
+        write_parquet(gdf2, output, geometry_table)
+    else:
+        output = os.path.join(Path_out, z_simple + '_FullStats.csv')
+        print("CSV statistics saved here: ", output)
+        gdf2.to_csv(output)
 
-    output = os.path.join(Path_out, z_simple + '_FullStats.csv')
-    print("CSV statistics saved here: ", output)
-    gdf2.to_csv(output)
-    for item in gdf2['ID'].unique():
-        gdf3 = gdf2[(gdf2.ID == item)]
-        output = os.path.join(
-            Path_out, z_simple + '_Stats_ID_' + str(item) + '.csv')
-        gdf3.to_csv(output)
+    if per_id == 'files':
+        write_partitions(gdf2, Path_out, z_simple + '_Stats_ID_', output_format, geometry_table)
+    elif per_id == 'dataset':
+        # One directory holding a file per ID, the geometry table sits one level up
+        output = os.path.join(Path_out, z_simple + '_Stats_ID')
+        print("Per ID statistics saved here: ", output)
+        write_partitions(gdf2, output, '', output_format,
+                         geometry_table and os.path.join(os.pardir, geometry_table))
 
     return gdf2
 
@@ -103,7 +239,8 @@ def mask_imagery(rasterin, mask, geom, NoDataValue, mask_value):
     mask_value : int(s)
         The value of a cloud or other anomaly mask (ex: Clouds/Cloud Shadow=1).
          Multiple values can be used and be split by commas (i.e. 1,2,99) if no
-          masking is required, leave blank.
+          masking is required, leave blank.  QA bit rules can be used too, see
+          mask_lut.
 
     Returns
     -------
@@ -116,20 +253,1057 @@ def mask_imagery(rasterin, mask, geom, NoDataValue, mask_value):
      full image in the future.  This improves computational performance.
     """
 
-    geom = geom.bounds
-    geom = [geom[0], geom[3], geom[2], geom[1]]
-    MRO = gdal.Translate("temp1.vrt", rasterin, projWin=geom).ReadAsArray()
-    MR2 = gdal.Translate("temp2.vrt", mask, projWin=geom).ReadAsArray()
-    r = rasterio.open("temp1.vrt")
-    affineO = r.transform
-    del r
-    for item in mask_value:
-        MRO[np.where(MR2 == int(item))] = NoDataValue
+    # Read the polygon window straight into memory, no intermediate files
+    with rasterio.open(rasterin) as src:
+        geotransform = src.transform.to_gdal()
+        window = get_window(geotransform, geom.bounds)
+        MRO = read_window(src, window)
+    with rasterio.open(mask) as msk:
+        MR2 = read_window(msk, window)
+    affineO = get_window_affine(geotransform, window)
+    MRO[mask_pixels(MR2, mask_value)] = NoDataValue
     return MRO, affineO
 
 
-def calculate_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit=True):
+_MASK_LUTS = {}
+
+
+def qa_rule(rule):
+    """Parse one QA bit rule of mask_lut.
+
+    Returns
+    -------
+    bit, width, op, level : the flag bits, the comparison and the level its
+    value is compared with.
+    """
+    for op in ('>=', '<=', '==', '>', '<', '='):
+        if op in rule:
+            name, level = [item.strip() for item in rule.split(op, 1)]
+            break
+    else:
+        name, op, level = rule.strip(), '>=', '1'
+    if name not in QA_BITS:
+        raise ValueError("Unknown mask value " + repr(rule) + ", use pixel values or the QA flags "
+                         + ", ".join(sorted(QA_BITS)))
+    level = QA_LEVELS[level] if level in QA_LEVELS else int(level)
+    bit, width = QA_BITS[name]
+    return bit, width, '==' if op == '=' else op, level
+
+
+def mask_lut(mask_value, dtype='uint16'):
+    """Make a lookup table of the masked values of a 16 bit (or smaller)
+    integer mask, so any number of mask values or QA bit rules are applied in
+    a single pass with lut[mask] (see mask_pixels).
+
+    Arguments
+    ---------
+    mask_value : list
+        Pixel values to mask (i.e. ['1', '2', '99']) and/or rules on the bits
+        of a Landsat pixel_qa band (see QA_BITS), so no mask rasters have to be
+        made from it first.  A flag name masks pixels where it is set (i.e.
+        'cloud', 'shadow', 'snow').  Confidence flags are compared with a
+        level of QA_LEVELS or a number (i.e. 'cloud_confidence>=medium',
+        'cirrus_confidence==high').
+    dtype : str
+        The integer dtype of the mask, defaults to uint16. Pixel values it can
+        not hold (i.e. -1 or 65536 for uint16) mask nothing.
+
+    Returns
+    -------
+    lut : a bool :class:`numpy.array` of 65,536 entries, ``True`` for masked
+    values.  Negative values are found at their uint16 (two's complement)
+    position.
+    """
+    info = np.iinfo(dtype)
+    key = (info.dtype.str,) + tuple(str(item).strip() for item in mask_value)
+    lut = _MASK_LUTS.get(key)
+    if lut is not None:
+        return lut
+    lut = np.zeros(65536, dtype=bool)
+    values = np.arange(65536, dtype=np.uint16)
+    for item in key[1:]:
+        if not item:
+            continue
+        if item.lstrip('-').isdigit():
+            if info.min <= int(item) <= info.max:
+                lut[int(item) & 0xFFFF] = True
+            continue
+        bit, width, op, level = qa_rule(item)
+        flag = (values >> bit) & ((1 << width) - 1)
+        if op == '>=':
+            lut |= flag >= level
+        elif op == '<=':
+            lut |= flag <= level
+        elif op == '>':
+            lut |= flag > level
+        elif op == '<':
+            lut |= flag < level
+        else:
+            lut |= flag == level
+    _MASK_LUTS[key] = lut
+    return lut
+
+
+def mask_pixels(MR2, mask_value):
+    """Find the masked pixels of a mask array.
+
+    Arguments
+    ---------
+    MR2 : a :class:`numpy.array`
+        The mask pixels.
+    mask_value : list
+        The mask values and QA bit rules, see mask_lut.
+
+    Returns
+    -------
+    masked : a bool :class:`numpy.array`, ``True`` where MR2 is masked.
+    """
+    if MR2.dtype.kind in 'ui' and MR2.dtype.itemsize <= 2:
+        return mask_lut(mask_value, MR2.dtype)[MR2.astype(np.uint16, copy=False)]
+    values = [str(item).strip() for item in mask_value if str(item).strip()]
+    if not all(item.lstrip('-').isdigit() for item in values):
+        raise ValueError("QA bit rules need a 16 bit (or smaller) integer mask, not " + str(MR2.dtype))
+    return np.isin(MR2, [int(item) for item in values])
+
+
+def get_window(geotransform, bounds, maskit=True):
+    """Get the pixel window of a raster that covers a set of bounds.
+
+    Arguments
+    ---------
+    geotransform : tuple
+        The GDAL style geotransform of the raster being read.
+    bounds : tuple
+        The (minx, miny, maxx, maxy) bounds of a polygon of interest.
+    maskit : bool
+        Which window to compute. If ``True`` the window is rounded the same way
+        ``gdal.Translate(projWin=...)`` clips an image for mask_imagery. If
+        ``False`` the window is the full cover window rasterstats reads for
+        an unmasked polygon.
+
+    Returns
+    -------
+    window : tuple
+        The window in GDAL srcWin format (xoff, yoff, xsize, ysize).
+    """
+    minx, miny, maxx, maxy = bounds
+    if maskit:
+        xoff = int(math.floor((minx - geotransform[0]) / geotransform[1] + 0.001))
+        yoff = int(math.floor((maxy - geotransform[3]) / geotransform[5] + 0.001))
+        xsize = int(math.floor((maxx - minx) / geotransform[1] + 0.5))
+        ysize = int(math.floor((miny - maxy) / geotransform[5] + 0.5))
+        return xoff, yoff, xsize, ysize
+    xoff = int(math.floor((minx - geotransform[0]) / geotransform[1]))
+    yoff = int(math.floor((maxy - geotransform[3]) / geotransform[5]))
+    xend = int(math.ceil((maxx - geotransform[0]) / geotransform[1]))
+    yend = int(math.ceil((miny - geotransform[3]) / geotransform[5]))
+    return xoff, yoff, xend - xoff, yend - yoff
+
+
+def get_window_affine(geotransform, window):
+    """Get the affine of a window, computed the same way GDAL does for a
+    translated image so polygons are rasterized on an identical grid."""
+    xoff, yoff = window[0], window[1]
+    return Affine(geotransform[1], geotransform[2],
+                  geotransform[0] + xoff * geotransform[1] + yoff * geotransform[2],
+                  geotransform[4], geotransform[5],
+                  geotransform[3] + xoff * geotransform[4] + yoff * geotransform[5])
+
+
+def read_window(src, window, band=1, out=None):
+    """Read a window from an open rasterio dataset.  Any part of the window
+    beyond the raster extent is filled with the dataset nodata value (or 0),
+    as a gdal.Translate clip would be.  If out (see get_buffer) is passed the
+    window is read straight into it instead of a new array."""
+    xoff, yoff, xsize, ysize = window
+    if xoff >= 0 and yoff >= 0 and xoff + xsize <= src.width and yoff + ysize <= src.height:
+        return src.read(band, window=Window(xoff, yoff, xsize, ysize), out=out)
+    fill = src.nodata if src.nodata is not None else 0
+    if out is None:
+        out = np.empty((ysize, xsize), dtype=src.dtypes[band - 1])
+    out.fill(fill)
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1, y1 = min(xoff + xsize, src.width), min(yoff + ysize, src.height)
+    if x1 > x0 and y1 > y0:
+        out[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = src.read(
+            band, window=Window(x0, y0, x1 - x0, y1 - y0))
+    return out
+
+
+_BUFFERS = threading.local()
+
+
+def get_buffer(name, window, dtype):
+    """Get a preallocated array to read a window into.  One buffer is kept per
+    name (i.e. 'data' or 'mask') and thread, and only grows, so reading
+    similar windows from raster after raster does not allocate new arrays.
+    The array is overwritten by the next read of the same name in the same
+    thread, so threads never share one."""
+    size = window[2] * window[3]
+    dtype = np.dtype(dtype)
+    buffers = getattr(_BUFFERS, 'arrays', None)
+    if buffers is None:
+        buffers = _BUFFERS.arrays = {}
+    buf = buffers.get(name)
+    if buf is None or buf.dtype != dtype or buf.size < size:
+        buf = np.empty(size, dtype)
+        buffers[name] = buf
+    return buf[:size].reshape(window[3], window[2])
+
+
+_ZONES = {}
+
+
+def hash_geoms(geoms):
+    """Hash a list of polygon geometries, used to key cached polygon pixels."""
+    digest = hashlib.sha1()
+    for geom in geoms:
+        digest.update(geom.wkb)
+    return digest.hexdigest()
+
+
+def replace_file(src, dst):
+    """Rename src to dst, replacing dst if it exists, so readers only ever see
+    a complete file.  Uses os.replace where it exists (Python 3) and os.rename
+    otherwise, which can not replace a file on Windows so dst is removed
+    first there."""
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+        return
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.remove(dst)
+        os.rename(src, dst)
+
+
+def get_zones(geoms, geotransform, maskit=True, cache_dir=None, geom_hash=None):
+    """Rasterize each polygon once per raster grid.  Every date of a time
+    series normally shares one grid, so the pixels of each polygon are found
+    once and reused for every image.  Results are kept in memory and,
+    optionally, on disk keyed by the grid and a hash of the polygons.
+
+    Arguments
+    ---------
+    geoms : list
+        The polygon geometries (areas of interest).
+    geotransform : tuple
+        The GDAL style geotransform of the raster grid.
+    maskit : bool
+        Whether the polygon windows follow mask_imagery (``True``) or the
+        rasterstats full cover window (``False``). See get_window.
+    cache_dir : str
+        Optional. A directory to save and load the rasterized polygons from.
+    geom_hash : str
+        Optional. The hash_geoms of geoms, if it has already been calculated.
+
+    Returns
+    -------
+    zones : dict
+        'union' the window covering all polygons, and 'indices' a list of flat
+        pixel indices into that window for each polygon, in the order of geoms.
+    """
+    if geom_hash is None:
+        geom_hash = hash_geoms(geoms)
+    key = hashlib.sha1(repr((geom_hash, tuple(geotransform), bool(maskit))).encode()).hexdigest()
+    if key in _ZONES:
+        return _ZONES[key]
+
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, 'zones_' + key + '.npz')
+    if path and os.path.exists(path):
+        cached = np.load(path)
+        offsets = cached['offsets']
+        zones = {'union': tuple(int(i) for i in cached['union']),
+                 'indices': np.split(cached['indices'], offsets[1:-1])}
+    else:
+        windows = [get_window(geotransform, geom.bounds, maskit) for geom in geoms]
+        xoff = min(w[0] for w in windows)
+        yoff = min(w[1] for w in windows)
+        union = (xoff, yoff,
+                 max(w[0] + w[2] for w in windows) - xoff,
+                 max(w[1] + w[3] for w in windows) - yoff)
+        indices = []
+        for geom, window in zip(geoms, windows):
+            if window[2] <= 0 or window[3] <= 0:
+                indices.append(np.zeros(0, dtype=np.intp))
+                continue
+            footprint = rasterize([(geom, 1)], out_shape=(window[3], window[2]),
+                                  transform=get_window_affine(geotransform, window),
+                                  fill=0, dtype='uint8')
+            rows, cols = np.nonzero(footprint)
+            indices.append((rows + window[1] - yoff) * union[2] + cols + window[0] - xoff)
+        zones = {'union': union, 'indices': indices}
+        if path:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            offsets = np.cumsum([0] + [len(i) for i in indices])
+            tmp = path + '.' + str(os.getpid()) + '.npz'
+            np.savez(tmp, union=np.array(union), offsets=offsets,
+                     indices=np.concatenate(indices).astype(np.intp))
+            replace_file(tmp, path)
+
+    if len(_ZONES) > 16:
+        _ZONES.clear()
+    _ZONES[key] = zones
+    return zones
+
+
+def pixel_stats(values, NoDataValue, stats=STATS):
+    """Calculate statistics from the pixel values of one polygon, the same way
+    rasterstats.zonal_stats does.
+
+    Arguments
+    ---------
+    values : a :class:`numpy.array`
+        The (flat) pixel values within the polygon.
+    NoDataValue : int
+        The value of blank space where no actual data resides in an image.
+    stats : str
+        The statistics to calculate, see STATS.
+
+    Returns
+    -------
+    statout : dict
+        The statistics of the polygon.
+    """
+    stats = stats.split()
+    valid = values != NoDataValue
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    values = values[valid]
+    if values.size == 0:
+        statout = dict((stat, None) for stat in stats)
+        if 'count' in stats:
+            statout['count'] = 0
+        return statout
+
+    accum = 'int64' if np.issubdtype(values.dtype, np.integer) else None
+    statout = {}
+    if 'min' in stats:
+        statout['min'] = float(values.min())
+    if 'max' in stats:
+        statout['max'] = float(values.max())
+    if 'mean' in stats:
+        statout['mean'] = float(values.sum(dtype=accum)) / values.size
+    if 'count' in stats:
+        statout['count'] = int(values.size)
+    if 'std' in stats:
+        statout['std'] = float(values.std(dtype='float64'))
+    if 'median' in stats:
+        statout['median'] = float(np.median(values))
+    for stat in stats:
+        if stat.startswith('percentile_'):
+            statout[stat] = np.percentile(values, float(stat[len('percentile_'):]))
+    return statout
+
+
+def get_labels(zones):
+    """Burn the polygons of a grid (see get_zones) into one label raster, the
+    flat window covering all polygons holding 1 + the index of the polygon at
+    each pixel and 0 elsewhere.  Returns ``None`` if polygons overlap, as a
+    pixel can then only carry one label."""
+    if 'labels' not in zones:
+        labels = np.zeros(zones['union'][2] * zones['union'][3], dtype=np.int32)
+        total = 0
+        for label, indices in enumerate(zones['indices'], 1):
+            labels[indices] = label
+            total += len(indices)
+        if np.count_nonzero(labels) != total:
+            labels = None
+        zones['labels'] = labels
+    return zones['labels']
+
+
+def label_stats(values, labels, nzones, NoDataValue, stats=STATS):
+    """Calculate pixel_stats for all polygons at once from a label raster.
+    Counts, means and standard deviations are bincount reductions, the other
+    statistics are read from the pixels sorted by label and value, so each
+    image costs one pass no matter how many polygons there are.
+
+    Arguments
+    ---------
+    values : a :class:`numpy.array`
+        The (flat) pixel values of the window covering all polygons.
+    labels : a :class:`numpy.array`
+        The matching label raster from get_labels.
+    nzones : int
+        The number of polygons.
+    NoDataValue : int
+        The value of blank space where no actual data resides in an image.
+    stats : str
+        The statistics to calculate, see STATS.
+
+    Returns
+    -------
+    statlist : list
+        A list of dicts containing the statistics for each polygon.
+    """
+    stats = stats.split()
+    valid = (labels > 0) & (values != NoDataValue)
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    lab = labels[valid] - 1
+    val = values[valid]
+    order = np.lexsort((val, lab))
+    lab = lab[order]
+    val = val[order]
+
+    count = np.bincount(lab, minlength=nzones)
+    start = np.cumsum(count) - count
+    last = np.maximum(start + count - 1, 0)
+    val64 = val.astype(np.float64)
+    safe = np.maximum(count, 1)
+    mean = np.bincount(lab, weights=val64, minlength=nzones) / safe
+    std = np.sqrt(np.bincount(lab, weights=(val64 - mean[lab]) ** 2, minlength=nzones) / safe)
+
+    def quantile(q):
+        # Linear interpolation between the closest ranks, as numpy.percentile
+        pos = (count - 1) * (q / 100.)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, np.maximum(count - 1, 0))
+        lo_val = val64[np.minimum(start + lo, len(val) - 1)]
+        hi_val = val64[np.minimum(start + hi, len(val) - 1)]
+        return lo_val + (hi_val - lo_val) * (pos - lo)
+
+    quantiles = {}
+    if len(val):
+        if 'median' in stats:
+            quantiles['median'] = quantile(50)
+        for stat in stats:
+            if stat.startswith('percentile_'):
+                quantiles[stat] = quantile(float(stat[len('percentile_'):]))
+
+    statlist = []
+    for idx in range(nzones):
+        if count[idx] == 0:
+            statout = dict((stat, None) for stat in stats)
+            if 'count' in stats:
+                statout['count'] = 0
+            statlist.append(statout)
+            continue
+        statout = {}
+        if 'min' in stats:
+            statout['min'] = float(val[start[idx]])
+        if 'max' in stats:
+            statout['max'] = float(val[last[idx]])
+        if 'mean' in stats:
+            statout['mean'] = float(mean[idx])
+        if 'count' in stats:
+            statout['count'] = int(count[idx])
+        if 'std' in stats:
+            statout['std'] = float(std[idx])
+        if 'median' in stats:
+            statout['median'] = float(quantiles['median'][idx])
+        for stat in stats:
+            if stat.startswith('percentile_'):
+                statout[stat] = float(quantiles[stat][idx])
+        statlist.append(statout)
+    return statlist
+
+
+def band_math_tree(text):
+    """Parse a band math expression, allowing only arithmetic and comparisons
+    of band names and numbers and calls to BAND_MATH_FUNCTIONS.  Numbers are
+    made floats so the expression is always calculated with numpy.
+
+    Returns
+    -------
+    tree, bands : the parsed :class:`ast.Expression` and the band names used,
+    in the order they appear.
+    """
+    tree = ast.parse(text.strip(), mode='eval')
+    functions = set()
+    names = []
+    bands = []
+    for node in ast.walk(tree):
+        if not isinstance(node, _BAND_MATH_NODES):
+            raise ValueError("Band math can not use " + type(node).__name__ + ": " + text)
+        if isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or node.func.id not in BAND_MATH_FUNCTIONS
+                    or node.keywords):
+                raise ValueError("Band math can only call " + ", ".join(sorted(BAND_MATH_FUNCTIONS))
+                                 + ": " + text)
+            functions.add(id(node.func))
+        elif isinstance(node, ast.Compare) and len(node.ops) > 1:
+            raise ValueError("Band math can not chain comparisons: " + text)
+        elif isinstance(node, _BAND_MATH_NUMBERS):
+            value = getattr(node, _BAND_MATH_NUMBER_FIELD)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError("Band math can only use numbers: " + text)
+            setattr(node, _BAND_MATH_NUMBER_FIELD, float(value))
+        elif isinstance(node, ast.Name) and id(node) not in functions:
+            names.append(node)
+    for node in sorted(names, key=lambda node: node.col_offset):
+        if node.id not in bands:
+            bands.append(node.id)
+    if not bands:
+        raise ValueError("Band math does not use any bands: " + text)
+    return tree, bands
+
+
+def parse_band_math(expression):
+    """Check a band math expression and find the bands it uses.
+
+    Arguments
+    ---------
+    expression : str
+        A preset in BAND_MATH_PRESETS (i.e. 'NDVI'), or an expression over the
+        band_num of a multi-band catalog, numbers, + - * / ** < <= > >= and
+        BAND_MATH_FUNCTIONS, named as 'name=expression' (i.e.
+        'SR=NIR / RED') where name is an identifier and = is not part of a
+        comparison.  Unnamed expressions are named by themselves.
+
+    Returns
+    -------
+    band_math : tuple
+        The name, expression and band names used.
+    """
+    name, text = expression.strip(), expression
+    named = re.match(r'\s*([A-Za-z_]\w*)\s*=(?!=)', expression)
+    if named:
+        name, text = named.group(1), expression[named.end():]
+    text = BAND_MATH_PRESETS.get(text.strip(), text)
+    return name, text.strip(), band_math_tree(text)[1]
+
+
+def eval_band_math(band_math, arrays):
+    """Calculate a parsed band math expression (see parse_band_math).
+
+    Arguments
+    ---------
+    band_math : tuple
+        The name, expression and band names from parse_band_math.
+    arrays : dict
+        A float :class:`numpy.array` of each band, NaN where there is no data.
+
+    Returns
+    -------
+    MRO : a float :class:`numpy.array`, NaN where any band has no data or the
+    result is not finite (i.e. divided by zero).
+    """
+    tree, bands = band_math_tree(band_math[1])
+    names = dict(BAND_MATH_FUNCTIONS)
+    names.update((band, arrays[band]) for band in bands)
+    with np.errstate(all='ignore'):
+        MRO = eval(compile(tree, '<band_math>', 'eval'), {'__builtins__': {}}, names)
+    MRO = np.array(np.broadcast_to(MRO, arrays[bands[0]].shape), dtype='float64')
+    MRO[~np.isfinite(MRO)] = np.nan
+    return MRO
+
+
+def calculate_raster_stats(raster, mask, geoms, NoDataValue, mask_value, maskit=True, stats=STATS,
+                           obs=None, obs_mask=None, cache_dir=None, geom_hash=None, backend='index'):
+    """Calculate statistics for every polygon from a single read of a raster.
+    The window covering all polygons is read (and masked) once, into reused
+    buffers (see get_buffer), the pixels of each polygon (see get_zones) are
+    then gathered from that in-memory array.
+
+    Arguments
+    ---------
+    raster : str
+        The specific path to a raster image of interest.
+    mask : str
+        The specific path to a mask image that specifies where anomalies area
+        that should be masked. Ignored if maskit is ``False``.
+    geoms : list
+        The polygon geometries (areas of interest) to calculate statistics for.
+    NoDataValue : int
+        The value of blank space where no actual data resides in an image.
+    mask_value : list
+        The value(s) of a cloud or other anomaly mask (ex: Clouds/Cloud Shadow=1).
+    maskit : bool
+        Should cloud or anomalies be masked? Defaults to yes (``True``).
+    stats : str
+        The rasterstats statistics to calculate for each polygon.
+    obs : str
+        Optional. The specific path to the number of observations raster of the
+        same date. Its median for each polygon is added to the statistics as
+        'observations', the same value get_num_obs calculates.
+    obs_mask : str
+        Optional. The mask of the observation raster, defaults to mask. When
+        the two are the same the mask is only read once.
+    cache_dir : str
+        Optional. A directory to cache the rasterized polygons in, see get_zones.
+    geom_hash : str
+        Optional. The hash_geoms of geoms, if it has already been calculated.
+    backend : str
+        How the polygon statistics are calculated. 'index' (default) gathers
+        the pixels of each polygon in turn. 'label' calculates all polygons at
+        once from a label raster (see label_stats), which is much faster for
+        thousands of polygons (i.e. a dense grid or census blocks).  Overlapping
+        polygons can not share a label raster and always use 'index'.
+
+    Returns
+    -------
+    statlist : list
+        A list of dicts containing the statistics for each polygon, in the same
+        order as geoms.
+    """
+    return calculate_scene_stats([raster], mask, geoms, NoDataValue, mask_value, maskit, stats, obs,
+                                 obs_mask, cache_dir, geom_hash, backend)[0]
+
+
+def calculate_scene_stats(rasters, mask, geoms, NoDataValue, mask_value, maskit=True, stats=STATS,
+                          obs=None, obs_mask=None, cache_dir=None, geom_hash=None, backend='index',
+                          bands=None, band_math=None):
+    """calculate_raster_stats for several bands of one scene that share a mask
+    (i.e. the Landsat bands of one date and its pixel_qa).  The polygon window,
+    rasterized polygons, mask and observations are read or found once and
+    reused for every band.
+
+    Arguments
+    ---------
+    rasters : list
+        The specific paths to the band rasters.  Bands not on the grid of the
+        first are calculated on their own.
+    bands : list
+        The band name of each raster, used by band_math.
+    band_math : list
+        Optional. Band math (see parse_band_math) to calculate from the masked
+        bands instead of the bands themselves.  Every band must be on the same
+        grid.
+    (all others)
+        See calculate_raster_stats.
+
+    Returns
+    -------
+    statlists : list
+        The statlist of each raster, in the same order as rasters, or of each
+        band_math.
+    """
+    if obs_mask is None:
+        obs_mask = mask
+    # The first band gives the grid and stays open for its own read
+    with rasterio.open(rasters[0]) as first:
+        statlists = scene_bands(first, rasters, mask, geoms, NoDataValue, mask_value, maskit, stats, obs,
+                                obs_mask, cache_dir, geom_hash, backend, bands, band_math)
+    if band_math:
+        if None in statlists:
+            raise ValueError("The bands used by band math are not on one grid: " + ", ".join(rasters))
+        return statlists
+    for idx, raster in enumerate(rasters):
+        if statlists[idx] is None:
+            statlists[idx] = calculate_scene_stats([raster], mask, geoms, NoDataValue, mask_value, maskit,
+                                                   stats, obs, obs_mask, cache_dir, None, backend)[0]
+    return statlists
+
+
+def scene_bands(first, rasters, mask, geoms, NoDataValue, mask_value, maskit, stats, obs, obs_mask,
+                cache_dir, geom_hash, backend, bands=None, band_math=None):
+    """The bands of calculate_scene_stats on the grid of the first (an open
+    dataset), None for the others.  With band_math the masked bands are kept
+    as floats and the statistics of each band_math are returned instead."""
+    OBS = None
+    obslist = None
+    geotransform = first.transform.to_gdal()
+    zones = get_zones(geoms, geotransform, maskit, cache_dir, geom_hash)
+    union = zones['union']
+    if obs is not None:
+        with rasterio.open(obs) as osrc:
+            if osrc.transform.to_gdal() == geotransform and obs_mask == mask:
+                OBS = read_window(osrc, union, out=get_buffer('obs', union, osrc.dtypes[0]))
+        if OBS is None:
+            # Not on the same grid or mask, so it needs its own pass. This
+            # runs first as it reuses the same data and mask buffers.
+            obslist = calculate_raster_stats(
+                obs, obs_mask, geoms, NoDataValue, mask_value, maskit, "median",
+                cache_dir=cache_dir, geom_hash=geom_hash, backend=backend)
+    masked = None
+    if maskit:
+        with rasterio.open(mask) as msk:
+            MR2 = read_window(msk, union, out=get_buffer('mask', union, msk.dtypes[0]))
+        masked = mask_pixels(MR2, mask_value)
+        if OBS is not None:
+            OBS[masked] = NoDataValue
+
+    statlists = []
+    arrays = {}
+    for idx, raster in enumerate(rasters):
+        src = first if idx == 0 else rasterio.open(raster)
+        try:
+            if src.transform.to_gdal() != geotransform:
+                statlists.append(None)
+                continue
+            MRO = read_window(src, union, out=get_buffer('data', union, src.dtypes[0]))
+        finally:
+            if idx > 0:
+                src.close()
+        if masked is not None:
+            MRO[masked] = NoDataValue
+        if band_math:
+            # NaN marks no data, the band math carries it through
+            arrays[bands[idx]] = np.where(MRO == NoDataValue, np.nan, MRO.astype('float64'))
+            continue
+        statlists.append(zone_stats(MRO, zones, NoDataValue, stats, OBS, obslist, backend))
+    if band_math and None not in statlists:
+        if OBS is not None:
+            OBS = np.where(OBS == NoDataValue, np.nan, OBS.astype('float64'))
+        statlists = [zone_stats(eval_band_math(item, arrays), zones, np.nan, stats, OBS, obslist, backend)
+                     for item in band_math]
+    return statlists
+
+
+def zone_stats(MRO, zones, NoDataValue, stats=STATS, OBS=None, obslist=None, backend='index'):
+    """Calculate statistics for every polygon from the (masked) window covering
+    all polygons.
+
+    Arguments
+    ---------
+    MRO : a :class:`numpy.array`
+        The pixel values of zones['union'].
+    zones : dict
+        The polygon pixels, see get_zones.
+    NoDataValue : int
+        The value of blank space where no actual data resides in an image.
+    stats : str
+        The statistics to calculate, see STATS.
+    OBS : a :class:`numpy.array`
+        Optional. The number of observations in zones['union'], its median for
+        each polygon is added as 'observations'.
+    obslist : list
+        Optional. The already calculated median number of observations of each
+        polygon, added as 'observations'.
+    backend : str
+        'index' (default) or 'label', see calculate_raster_stats.
+
+    Returns
+    -------
+    statlist : list
+        A list of dicts containing the statistics for each polygon.
+    """
+    MRO = MRO.ravel()
+    if OBS is not None:
+        OBS = OBS.ravel()
+    nzones = len(zones['indices'])
+    labels = get_labels(zones) if backend == 'label' else None
+    if labels is not None:
+        statlist = label_stats(MRO, labels, nzones, NoDataValue, stats)
+        if OBS is not None:
+            obslist = label_stats(OBS, labels, nzones, NoDataValue, "median")
+        if obslist is not None:
+            for statout, obsout in zip(statlist, obslist):
+                statout['observations'] = obsout['median']
+        return statlist
+
+    statlist = []
+    for idx, indices in enumerate(zones['indices']):
+        statout = pixel_stats(MRO[indices], NoDataValue, stats)
+        if OBS is not None:
+            statout['observations'] = pixel_stats(OBS[indices], NoDataValue, "median")['median']
+        elif obslist is not None:
+            statout['observations'] = obslist[idx]['median']
+        statlist.append(statout)
+    return statlist
+
+
+def shard_by_date(data):
+    """Split the rows of a (date sorted) catalog into one list of row dicts per
+    date, keeping the catalog order."""
+    shards = []
+    for row in data.to_dict('records'):
+        if shards and shards[-1][0]['date'] == row['date']:
+            shards[-1].append(row)
+        else:
+            shards.append([row])
+    return shards
+
+
+def file_signature(path):
+    """Identify a version of a file by its path, size and modification time."""
+    if not isinstance(path, str):
+        return None
+    status = os.stat(path)
+    return [os.path.abspath(path), status.st_size, status.st_mtime]
+
+
+def cached_raster_stats(result_cache, raster, mask, geoms, geom_hashes, NoDataValue, mask_value,
+                        maskit=True, stats=STATS, obs=None, obs_mask=None, cache_dir=None,
+                        backend='index'):
+    """calculate_raster_stats, keeping the result of every raster/polygon pair
+    in a result cache.  Only pairs missing from the cache are calculated and
+    the cache of each raster is saved as soon as it is done, so re-runs only
+    process new or changed imagery or polygons and an interrupted run resumes
+    where it stopped.
+
+    Results are stored in one file per raster, keyed by the path, size and
+    modification time of the raster, its mask and observation raster, and by
+    NoDataValue, mask_value, maskit and stats.  Within the file each polygon
+    is keyed by a hash of its geometry.
+
+    Arguments
+    ---------
+    result_cache : str
+        The directory the results are stored in.
+    geom_hashes : list
+        The sha1 hash of each polygon geometry (WKB), in the same order as geoms.
+    (all others)
+        See calculate_raster_stats.
+
+    Returns
+    -------
+    statlist : list
+        A list of dicts containing the statistics for each polygon, in the same
+        order as geoms.
+    """
+    if obs_mask is None:
+        obs_mask = mask
+    settings = [file_signature(raster), file_signature(mask) if maskit else None,
+                file_signature(obs), file_signature(obs_mask) if obs and maskit else None,
+                NoDataValue, [str(item) for item in mask_value] if maskit else None,
+                bool(maskit), stats]
+    key = hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+    path = os.path.join(result_cache, 'stats_' + key + '.json')
+    cached = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            cached = json.load(f)
+
+    missing = [idx for idx, geom_hash in enumerate(geom_hashes) if geom_hash not in cached]
+    if missing:
+        missing_hashes = [geom_hashes[idx] for idx in missing]
+        statlist = calculate_raster_stats(
+            raster, mask, [geoms[idx] for idx in missing], NoDataValue, mask_value, maskit, stats,
+            obs, obs_mask, cache_dir, hashlib.sha1(''.join(missing_hashes).encode()).hexdigest(),
+            backend)
+        cached.update(zip(missing_hashes, statlist))
+        if not os.path.exists(result_cache):
+            os.makedirs(result_cache)
+        tmp = path + '.' + str(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(cached, f)
+        replace_file(tmp, path)
+    return [dict(cached[geom_hash]) for geom_hash in geom_hashes]
+
+
+def prune_shards(shards, gdf):
+    """Match each raster to the polygons that intersect its bounds, as stored
+    by csv_it, using a spatial index over the polygons.  Raster/polygon pairs
+    that do not overlap (i.e. Landsat scenes of another path/row) are then
+    never read.  Each row is given a 'polygons' array, the positions in gdf of
+    the polygons to evaluate.  Rows without bounds or an extent keep every
+    polygon.
+
+    Returns
+    -------
+    evaluated, total : int
+        The number of raster/polygon pairs that will be evaluated, and the
+        number there would have been without pruning.
+    """
+    geoms = list(gdf['geometry'])
+    everything = np.arange(len(geoms))
+    sindex = gdf.sindex
+    hits = {}
+    evaluated = 0
+    total = 0
+    for shard in shards:
+        for row in shard:
+            bounds = None
+            if not pd.isnull(row.get('minx', np.nan)):
+                bounds = (row['minx'], row['miny'], row['maxx'], row['maxy'])
+            elif isinstance(row.get('extent'), str):
+                # Catalogs from before the typed columns only have the extent
+                minx, maxy, maxx, miny = json.loads(row['extent'])
+                bounds = (minx, miny, maxx, maxy)
+            total += len(geoms)
+            if bounds is None:
+                row['polygons'] = everything
+            else:
+                if bounds not in hits:
+                    footprint = box(*bounds)
+                    candidates = sorted(sindex.intersection(footprint.bounds))
+                    hits[bounds] = np.array([i for i in candidates if geoms[i].intersects(footprint)],
+                                            dtype=np.intp)
+                row['polygons'] = hits[bounds]
+            evaluated += len(row['polygons'])
+    return evaluated, total
+
+
+def scene_key(row):
+    """Catalog rows with the same key are bands of one scene: in the same
+    directory, with the same mask and polygons to evaluate."""
+    polygons = row.get('polygons')
+    return (os.path.dirname(row['File']), row.get('Mask'),
+            None if polygons is None else np.asarray(polygons).tobytes())
+
+
+def row_inputs(row, obs_rows, geoms, geom_hash):
+    """The observation raster and polygons date_stats evaluates a row with.
+
+    Returns
+    -------
+    obs, obs_mask, row_geoms, row_hash : the observation raster and its mask
+    (or None), and the polygons of the row with their hash_geoms.
+    """
+    obs, obs_mask = None, None
+    if obs_rows:
+        # Prefer the observation raster that shares this raster's mask
+        match = [o for o in obs_rows if o.get('Mask') == row.get('Mask')] or obs_rows
+        obs, obs_mask = match[0]['File'], match[0].get('Mask')
+    row_geoms, row_hash = geoms, geom_hash
+    polygons = row.get('polygons')
+    if polygons is not None and len(polygons) < len(geoms):
+        row_geoms = [geoms[i] for i in polygons]
+        if geom_hash is not None:
+            row_hash = hashlib.sha1(geom_hash.encode() + np.asarray(polygons, np.int64).tobytes()).hexdigest()
+    return obs, obs_mask, row_geoms, row_hash
+
+
+def date_stats(rows, geoms, NoDataValue, mask_value, maskit=True, stats=STATS, observations=False,
+               cache_dir=None, geom_hash=None, backend='index', result_cache=None, geom_hashes=None,
+               band_math=None):
+    """Calculate statistics for every polygon for each raster of one date.
+
+    With observations, the number of observations rasters (obs == 1) of the
+    date are not reported on their own.  Instead, in the same pass, their
+    median for each polygon is joined onto each data raster of that date.
+
+    Rows pruned by prune_shards are only evaluated for their 'polygons'. With a
+    result_cache (and the geom_hashes of geoms) results are kept and reused
+    through cached_raster_stats.  Otherwise the bands of a scene (rows with a
+    band_num in the same directory, with the same mask and polygons) are
+    calculated together by calculate_scene_stats.
+
+    With band_math (parsed by parse_band_math) each scene reports its band
+    math instead of its bands, as a row with the band math name as band_num
+    and the first band used as File.  Scenes missing a band are skipped.
+
+    Returns
+    -------
+    results : list
+        (row, statlist) pairs, one for each raster reported.
+    """
+    obs_rows = []
+    if observations:
+        obs_rows = [row for row in rows if row['obs'] == 1 and row['TS_Data'] != 1]
+        rows = [row for row in rows if row['TS_Data'] == 1]
+    if band_math:
+        return band_math_stats(rows, obs_rows, geoms, NoDataValue, mask_value, maskit, stats,
+                               cache_dir, geom_hash, backend, band_math)
+    scenes = {}
+    if not result_cache:
+        for row in rows:
+            if not pd.isnull(row.get('band_num', np.nan)):
+                scenes.setdefault(scene_key(row), []).append(row)
+    done = {}
+    results = []
+    for row in rows:
+        if id(row) in done:
+            results.append((row, done.pop(id(row))))
+            continue
+        obs, obs_mask, row_geoms, row_hash = row_inputs(row, obs_rows, geoms, geom_hash)
+        if len(row_geoms) == 0:
+            results.append((row, []))
+            continue
+        if result_cache:
+            row_hashes = geom_hashes
+            if row_geoms is not geoms:
+                row_hashes = [geom_hashes[i] for i in row['polygons']]
+            statlist = cached_raster_stats(result_cache, row['File'], row.get('Mask'), row_geoms,
+                                           row_hashes, NoDataValue, mask_value, maskit, stats,
+                                           obs, obs_mask, cache_dir, backend)
+        else:
+            scene = [row]
+            if not pd.isnull(row.get('band_num', np.nan)):
+                scene = scenes[scene_key(row)]
+            statlists = calculate_scene_stats([item['File'] for item in scene], row.get('Mask'), row_geoms,
+                                              NoDataValue, mask_value, maskit, stats, obs, obs_mask,
+                                              cache_dir, row_hash, backend)
+            statlist = statlists[0]
+            for item, itemstats in zip(scene[1:], statlists[1:]):
+                done[id(item)] = itemstats
+        results.append((row, statlist))
+    return results
+
+
+def band_math_stats(rows, obs_rows, geoms, NoDataValue, mask_value, maskit, stats, cache_dir, geom_hash,
+                    backend, band_math):
+    """The band_math of date_stats, calculated scene by scene."""
+    scenes = {}
+    for row in rows:
+        scenes.setdefault(scene_key(row), []).append(row)
+    results = []
+    for scene in scenes.values():
+        files = dict((item['band_num'], item['File']) for item in scene)
+        usable = [item for item in band_math if all(band in files for band in item[2])]
+        if not usable:
+            continue
+        bands = []
+        for item in usable:
+            bands.extend(band for band in item[2] if band not in bands)
+        row = scene[0]
+        obs, obs_mask, row_geoms, row_hash = row_inputs(row, obs_rows, geoms, geom_hash)
+        statlists = [[] for item in usable]
+        if len(row_geoms):
+            statlists = calculate_scene_stats([files[band] for band in bands], row.get('Mask'), row_geoms,
+                                              NoDataValue, mask_value, maskit, stats, obs, obs_mask,
+                                              cache_dir, row_hash, backend, bands, usable)
+        for item, statlist in zip(usable, statlists):
+            results.append((dict(row, band_num=item[0], File=files[item[2][0]]), statlist))
+    return results
+
+
+_POOL_ARGS = {}
+
+
+def _init_pool(kwargs):
+    _POOL_ARGS.clear()
+    _POOL_ARGS.update(kwargs)
+
+
+def _pool_date_stats(rows):
+    return date_stats(rows, **_POOL_ARGS)
+
+
+def map_dates(shards, workers=1, **kwargs):
+    """Run date_stats over each date shard, optionally across a process pool.
+
+    Arguments
+    ---------
+    shards : list
+        Lists of catalog rows, one per date, as made by shard_by_date.
+    workers : int
+        The number of processes to use. Defaults to 1, run in this process.
+    **kwargs
+        The remaining arguments of date_stats, sent once to each worker.
+
+    Yields
+    ------
+    results : the (row, statlist) pairs of each date from date_stats, always in
+    the same order as shards.  At most 2 * workers dates are in flight at
+    once so a large pool can not pile up results in memory.
+    """
+    if workers <= 1:
+        for shard in shards:
+            yield date_stats(shard, **kwargs)
+        return
+
+    pool = Pool(workers, initializer=_init_pool, initargs=(kwargs,))
+    try:
+        pending = deque()
+        for shard in shards:
+            pending.append(pool.apply_async(_pool_date_stats, (shard,)))
+            if len(pending) >= 2 * workers:
+                result = pending.popleft()
+                yield result.get()
+        while pending:
+            result = pending.popleft()
+            yield result.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def calculate_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit=True, workers=1,
+                          observations=False, cache_dir=None, backend='index', result_cache=None,
+                          query=None, band_math=None):
     """Calculate various statistics for each poylgon for a time series of imagery.
+    All results are kept in memory, see stream_zonal_stats to write them out as
+    they are calculated instead.
 
     Arguments
     ---------
@@ -152,6 +1326,25 @@ def calculate_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit=Tr
         Should cloud or anomalies be masked? Defaults to yes (``True``). If true
         the function will use the mask_value(s) passed to automatically remove
         any anomalies from the time series of imagery.
+    workers : int
+        The number of processes to spread the imagery across, split by date.
+        Defaults to 1 (no process pool).
+    observations : bool
+        Also calculate the number of observations (see get_num_obs) in the same
+        pass, joined to the imagery by date as an 'observations' column.
+        Defaults to ``False``.
+    cache_dir : str
+        Optional. A directory to cache the rasterized polygons in, see get_zones.
+    backend : str
+        'index' (default) or 'label', see calculate_raster_stats.
+    result_cache : str
+        Optional. A directory to keep the statistics of every raster/polygon
+        pair in, so re-runs only calculate new pairs, see cached_raster_stats.
+    query : dict
+        Optional. Only process the catalog rows matching it, see read_catalog.
+    band_math : list
+        Optional. Band math expressions (see parse_band_math) to calculate for
+        each scene of a multi-band catalog, reported in place of its bands.
 
     Returns
     -------
@@ -159,44 +1352,155 @@ def calculate_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit=Tr
     ploygons and all imagery in the time series. Additonally all statistics for
     each individual polygon will be output in csv format to the Path_out directory.
     """
-    data = pd.read_csv(directory_csv)
+    batches = list(iter_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit, workers,
+                                    observations, cache_dir, backend, result_cache, query=query,
+                                    band_math=band_math))
+    if not batches:
+        return gpd.GeoDataFrame()
+    gdf2 = pd.concat(batches, ignore_index=True)
+    geoms = list(gdf['geometry'])
+    gdf2.insert(gdf2.columns.get_loc('ID'), 'geometry', [geoms[idx - 1] for idx in gdf2['ID']])
+    gdf2 = gpd.GeoDataFrame(gdf2)
+    return gdf2
+
+
+def iter_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit=True, workers=1,
+                     observations=False, cache_dir=None, backend='index', result_cache=None,
+                     batch_size=10000, query=None, band_math=None):
+    """Calculate statistics like calculate_zonal_stats, yielding them in batches
+    as the imagery is processed so only one batch is held in memory at a time.
+    Batches carry the polygon ID but not its geometry.
+
+    Arguments
+    ---------
+    batch_size : int
+        Dates are gathered into batches of at least this many rows. Defaults
+        to 10000.
+    (all others)
+        See calculate_zonal_stats.
+
+    Yields
+    ------
+    batch : a :class:`pandas.DataFrame`
+        The statistics, ID, date and image of each raster/polygon pair, in date
+        order.  For catalogs with a band_num, its 'band' too, or the name of
+        the band math.  With observations, and observation rasters in the
+        catalog, 'observations' last (NaN for dates without one).  Every batch
+        has the same columns.
+    """
+    if band_math:
+        # Only the bands used by the band math are read. Its results are not
+        # kept in the result cache, which is keyed by raster
+        band_math = [parse_band_math(item) for item in band_math]
+        result_cache = None
+        query = dict(query or {}, band=sorted(set(band for item in band_math for band in item[2])))
+    data = read_catalog(directory_csv, query)
+    if band_math and 'band_num' not in data.columns:
+        raise ValueError("band_math needs a catalog with a band_num, see ls_csv_it")
     data = data.sort_values(['date'])
+    if observations and 'obs' in data.columns:
+        shards = shard_by_date(data[(data['TS_Data'] == 1) | (data['obs'] == 1)])
+    else:
+        shards = shard_by_date(data[data['TS_Data'] == 1])
+    evaluated, total = prune_shards(shards, gdf)
+    # Multi-band catalogs (see ls_csv_it) are reported in one output keyed by band
+    bands = 'band_num' in data.columns and data.loc[data['TS_Data'] == 1, 'band_num'].notnull().any()
+    # Every batch gets the same columns in the same order, so streamed output
+    # has one header or schema even if only some dates have observations
+    columns = list(pixel_stats(np.zeros(1), -1)) + ['ID', 'date', 'image']
+    if bands:
+        columns.append('band')
+    if observations and 'obs' in data.columns and (data['obs'] == 1).any():
+        columns.append('observations')
+    geoms = list(gdf['geometry'])
     zonelist = []
     print("Processing...")
-    for idx, row in tqdm(data.iterrows(), total=data.shape[0]):
-        if row['TS_Data'] == 1:
-            raster = row['File']
-            count = 0
-            date = row['date']
-            for idx, feature in gdf.iterrows():
-                count += 1
-                if maskit:
-                    MR, affine = mask_imagery(
-                        raster, row['Mask'], feature['geometry'], NoDataValue, mask_value)
-                    statout = zonal_stats(
-                        feature["geometry"],
-                        MR,
-                        stats="min max median mean std percentile_25 percentile_75 count",
-                        nodata=NoDataValue,
-                        affine=affine)
-                if maskit is False:
-                    statout = zonal_stats(
-                        feature["geometry"],
-                        raster,
-                        stats="min max median mean std percentile_25 percentile_75 count",
-                        nodata=NoDataValue)
-
-                statout[0]['geometry'] = feature['geometry']
-                statout[0]['ID'] = count
-                statout[0]['date'] = pd.to_datetime(
-                    date, infer_datetime_format=True)
-                statout[0]['image'] = raster
-                zonelist.append(statout[0])
-    gdf2 = gpd.GeoDataFrame(zonelist)
-    return gdf2
+    results = map_dates(shards, workers, geoms=geoms, NoDataValue=NoDataValue,
+                        mask_value=mask_value, maskit=maskit, stats=STATS,
+                        observations=observations, cache_dir=cache_dir,
+                        geom_hash=hash_geoms(geoms), backend=backend,
+                        result_cache=result_cache,
+                        geom_hashes=[hash_geoms([geom]) for geom in geoms] if result_cache else None,
+                        band_math=band_math)
+    for result in tqdm(results, total=len(shards)):
+        for row, statlist in result:
+            for idx, statout in zip(row['polygons'], statlist):
+                statout['ID'] = idx + 1
+                statout['date'] = row['date']
+                statout['image'] = row['File']
+                if bands:
+                    statout['band'] = row.get('band_num')
+                zonelist.append(statout)
+        if len(zonelist) >= batch_size:
+            yield pd.DataFrame(zonelist, columns=columns)
+            zonelist = []
+    if zonelist:
+        yield pd.DataFrame(zonelist, columns=columns)
+    print("Evaluated", evaluated, "of", total, "raster/polygon pairs,",
+          total - evaluated, "skipped as they do not overlap")
 
 
-def get_num_obs(directory_csv, gdf, NoDataValue, mask_value, maskit=True):
+def stream_zonal_stats(directory_csv, gdf, output, NoDataValue, mask_value, maskit=True, workers=1,
+                       observations=False, cache_dir=None, backend='index', result_cache=None,
+                       geometry_table=None, batch_size=10000, query=None, band_math=None):
+    """Calculate statistics like calculate_zonal_stats and write each batch from
+    iter_zonal_stats to output as soon as it is ready, so memory use does not
+    grow with the number of dates or polygons.
+
+    Arguments
+    ---------
+    output : str
+        The path to write to. Files ending in '.parquet' are written as parquet
+        (see write_parquet), without geometry. Others are written as csv, in
+        the same format as calculate_zonal_stats(...).to_csv(output).
+    geometry_table : str
+        Optional. The parquet geometry table relative to output, see
+        write_parquet.
+    (all others)
+        See iter_zonal_stats.
+
+    Returns
+    -------
+    rows : int
+        The number of rows written.
+    """
+    batches = iter_zonal_stats(directory_csv, gdf, NoDataValue, mask_value, maskit, workers,
+                               observations, cache_dir, backend, result_cache, batch_size, query,
+                               band_math)
+    rows = 0
+    if output.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for batch in batches:
+                if writer is None:
+                    # Fix the column types up front, a batch may be all empty
+                    types = {'ID': pa.int64(), 'date': pa.timestamp('ns'), 'image': pa.string(),
+                             'band': pa.string(), 'count': pa.int64()}
+                    schema = pa.schema([(column, types.get(column, pa.float64()))
+                                        for column in batch.columns])
+                    if geometry_table:
+                        schema = schema.with_metadata({b'CometTS_geometry': geometry_table.encode()})
+                    writer = pq.ParquetWriter(output, schema)
+                writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+                rows += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        return rows
+
+    wkts = [geom.wkt for geom in gdf['geometry']]
+    for batch in batches:
+        batch.insert(batch.columns.get_loc('ID'), 'geometry', [wkts[idx - 1] for idx in batch['ID']])
+        batch.index = range(rows, rows + len(batch))
+        batch.to_csv(output, mode='w' if rows == 0 else 'a', header=rows == 0)
+        rows += len(batch)
+    return rows
+
+
+def get_num_obs(directory_csv, gdf, NoDataValue, mask_value, maskit=True, workers=1, cache_dir=None,
+                backend='index', result_cache=None, query=None):
     """When working with monthly composite data it may be necessary to calculate
     the number of observations per pixel per month.  For example the VIIRS
     monthly data offers such files.  This function will enable future plotting of
@@ -224,6 +1528,16 @@ def get_num_obs(directory_csv, gdf, NoDataValue, mask_value, maskit=True):
         Should cloud or anomalies be masked? Defaults to yes (``True``). If true
         the function will use the mask_value(s) passed to automatically remove
         any anomalies from the time series of imagery.
+    workers : int
+        The number of processes to spread the imagery across, split by date.
+        Defaults to 1 (no process pool).
+    cache_dir : str
+        Optional. A directory to cache the rasterized polygons in, see get_zones.
+    backend : str
+        'index' (default) or 'label', see calculate_raster_stats.
+    result_cache : str
+        Optional. A directory to keep the statistics of every raster/polygon
+        pair in, so re-runs only calculate new pairs, see cached_raster_stats.
 
     Returns
     -------
@@ -233,44 +1547,377 @@ def get_num_obs(directory_csv, gdf, NoDataValue, mask_value, maskit=True):
     Specifically contains the number of observations per month in the "Median"
     column.
     """
-    data = pd.read_csv(directory_csv)
+    data = read_catalog(directory_csv, query)
     data = data.sort_values(['date'])
+    shards = shard_by_date(data[data['obs'] == 1])
+    prune_shards(shards, gdf)
+    geoms = list(gdf['geometry'])
     zonelist = []
     print("Getting number of observations...")
-    for idx, row in tqdm(data.iterrows(), total=data.shape[0]):
-        if row['obs'] == 1:
-            raster = row['File']
-            count = 0
-            date = row['date']
-            for idx, feature in gdf.iterrows():
-                count += 1
-                MR = raster
-                if maskit:
-                    MR, affine = mask_imagery(
-                        raster, row['Mask'], feature['geometry'], NoDataValue, mask_value)
-                    statout = zonal_stats(
-                        feature["geometry"],
-                        MR,
-                        stats="median",
-                        nodata=NoDataValue,
-                        affine=affine)
-
-                if not maskit:
-                    statout = zonal_stats(
-                        feature["geometry"],
-                        raster,
-                        stats="median",
-                        nodata=NoDataValue)
-
-                statout[0]['ID'] = count
-                statout[0]['date'] = pd.to_datetime(
-                    date, infer_datetime_format=True)
-                zonelist.append(statout[0])
+    results = map_dates(shards, workers, geoms=geoms, NoDataValue=NoDataValue,
+                        mask_value=mask_value, maskit=maskit, stats="median",
+                        cache_dir=cache_dir, geom_hash=hash_geoms(geoms), backend=backend,
+                        result_cache=result_cache,
+                        geom_hashes=[hash_geoms([geom]) for geom in geoms] if result_cache else None)
+    for result in tqdm(results, total=len(shards)):
+        for row, statlist in result:
+            for idx, statout in zip(row['polygons'], statlist):
+                statout['ID'] = idx + 1
+                statout['date'] = row['date']
+                zonelist.append(statout)
 
     gdf3 = gpd.GeoDataFrame(zonelist)
     return gdf3
 
 
+def cube_dtype(dtype):
+    """The cube dtype of a raster dtype, the smallest float that holds it exactly."""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.floating):
+        return dtype
+    if dtype.itemsize <= 2:
+        return np.dtype('float32')
+    return np.dtype('float64')
+
+
+def cube_layer(row, zones, NoDataValue, mask_value, maskit=True, geotransform=None):
+    """Read the cube window of one raster as float, with NaN for NoData and
+    masked pixels."""
+    with rasterio.open(row['File']) as src:
+        if geotransform is not None and src.transform.to_gdal() != geotransform:
+            raise ValueError(row['File'] + " is not on the same grid as the rest of the cube")
+        layer = read_window(src, zones['union']).astype(cube_dtype(src.dtypes[0]))
+    layer[layer == NoDataValue] = np.nan
+    if maskit:
+        with rasterio.open(row['Mask']) as msk:
+            MR2 = read_window(msk, zones['union'], out=get_buffer('mask', zones['union'], msk.dtypes[0]))
+        layer[mask_pixels(MR2, mask_value)] = np.nan
+    return layer
+
+
+def build_cube(directory_csv, gdf, cube_dir, NoDataValue, mask_value, maskit=True, query=None):
+    """Extract the window covering the polygons of interest from every date in
+    the catalog into one memory-mapped (time, y, x) array on disk, so later
+    analyses never decode the source rasters again.
+
+    The cube directory holds 'data.npy' (and 'obs.npy' for the number of
+    observations rasters, if the catalog has any) in a float dtype (see
+    cube_dtype) with NaN for NoData and masked pixels, and 'cube.json' with the
+    geotransform, CRS, dates, files and settings (see cube_settings).  All
+    rasters must share one grid and be of one band, so a multi-band catalog
+    (see ls_csv_it) needs a query for one band.
+
+    Arguments
+    ---------
+    cube_dir : str
+        The directory to write the cube to.
+    (all others)
+        See calculate_zonal_stats.
+
+    Returns
+    -------
+    cube : dict
+        The cube, see load_cube.
+    """
+    data = read_catalog(directory_csv, query)
+    if 'band_num' in data.columns and data.loc[data['TS_Data'] == 1, 'band_num'].nunique() > 1:
+        raise ValueError("A cube holds one band, query one band_num of " + directory_csv)
+    data = data.sort_values(['date'])
+    shards = shard_by_date(data[(data['TS_Data'] == 1) | (data['obs'] == 1)]
+                           if 'obs' in data.columns else data[data['TS_Data'] == 1])
+    layers = []
+    for rows in shards:
+        obs_rows = [row for row in rows if row.get('obs') == 1 and row['TS_Data'] != 1]
+        for row in rows:
+            if row['TS_Data'] != 1:
+                continue
+            match = [o for o in obs_rows if o.get('Mask') == row.get('Mask')] or obs_rows
+            layers.append((row, match[0] if match else None))
+    if not layers:
+        raise ValueError("No imagery in " + directory_csv)
+
+    with rasterio.open(layers[0][0]['File']) as src:
+        geotransform = src.transform.to_gdal()
+        crs = src.crs.to_wkt() if src.crs else None
+        dtype = cube_dtype(src.dtypes[0])
+    zones = get_zones(list(gdf['geometry']), geotransform, maskit)
+    union = zones['union']
+    if not os.path.exists(cube_dir):
+        os.makedirs(cube_dir)
+    shape = (len(layers), union[3], union[2])
+    cube = np.lib.format.open_memmap(os.path.join(cube_dir, 'data.npy'), mode='w+',
+                                     dtype=dtype, shape=shape)
+    obscube = None
+    obs_files = [obs['File'] for _, obs in layers if obs is not None]
+    if obs_files:
+        with rasterio.open(obs_files[0]) as osrc:
+            obs_dtype = cube_dtype(osrc.dtypes[0])
+        obscube = np.lib.format.open_memmap(os.path.join(cube_dir, 'obs.npy'), mode='w+',
+                                            dtype=obs_dtype, shape=shape)
+    print("Building cube...")
+    for t, (row, obs) in enumerate(tqdm(layers)):
+        cube[t] = cube_layer(row, zones, NoDataValue, mask_value, maskit, geotransform)
+        if obscube is not None:
+            if obs is None:
+                obscube[t] = np.nan
+            else:
+                obscube[t] = cube_layer(obs, zones, NoDataValue, mask_value, maskit, geotransform)
+    cube.flush()
+    if obscube is not None:
+        obscube.flush()
+        del obscube
+    del cube
+
+    meta = {'geotransform': get_window_affine(geotransform, union).to_gdal(), 'crs': crs,
+            'dates': [row['date'].strftime('%Y-%m-%d') for row, _ in layers],
+            'files': [row['File'] for row, _ in layers]}
+    meta.update(cube_settings(directory_csv, gdf, NoDataValue, mask_value, maskit, query))
+    with open(os.path.join(cube_dir, 'cube.json'), 'w') as f:
+        json.dump(meta, f)
+    return load_cube(cube_dir)
+
+
+def cube_settings(directory_csv, gdf, NoDataValue, mask_value, maskit=True, query=None):
+    """The settings a cube is built with, stored in its cube.json: the catalog
+    version (see file_signature), the polygons (see hash_geoms), NoDataValue,
+    mask_value, maskit and query.  A cube only holds the window of its
+    polygons and the imagery of its catalog at the time it was built, so it
+    can not be reused when any of them change."""
+    return {'catalog': file_signature(directory_csv), 'geom_hash': hash_geoms(list(gdf['geometry'])),
+            'NoDataValue': NoDataValue,
+            'mask_value': [str(item) for item in mask_value] if maskit else None,
+            'maskit': bool(maskit), 'query': json.loads(json.dumps(query))}
+
+
+def cube_is_current(cube_dir, directory_csv, gdf, NoDataValue, mask_value, maskit=True, query=None):
+    """Check if the cube in cube_dir exists and was built with the same
+    cube_settings, so it can be used instead of building it again."""
+    path = os.path.join(cube_dir, 'cube.json')
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        meta = json.load(f)
+    settings = cube_settings(directory_csv, gdf, NoDataValue, mask_value, maskit, query)
+    return all(meta.get(key) == value for key, value in settings.items())
+
+
+def load_cube(cube_dir, mmap_mode='r'):
+    """Open a cube written by build_cube.
+
+    Arguments
+    ---------
+    cube_dir : str
+        The cube directory.
+    mmap_mode : str
+        How the arrays are memory-mapped, see :func:`numpy.load`. Defaults to
+        read only.
+
+    Returns
+    -------
+    cube : dict
+        The cube.json metadata plus 'data' the (time, y, x) array, 'obs' the
+        number of observations array (or ``None``) and 'affine'.
+    """
+    with open(os.path.join(cube_dir, 'cube.json')) as f:
+        cube = json.load(f)
+    cube['data'] = np.load(os.path.join(cube_dir, 'data.npy'), mmap_mode=mmap_mode)
+    obs = os.path.join(cube_dir, 'obs.npy')
+    cube['obs'] = np.load(obs, mmap_mode=mmap_mode) if os.path.exists(obs) else None
+    cube['affine'] = Affine.from_gdal(*cube['geotransform'])
+    return cube
+
+
+def read_cube_window(layer, window):
+    """Read a window from one (y, x) layer of a cube, NaN beyond its extent."""
+    xoff, yoff, xsize, ysize = window
+    if xoff >= 0 and yoff >= 0 and xoff + xsize <= layer.shape[1] and yoff + ysize <= layer.shape[0]:
+        return np.asarray(layer[yoff:yoff + ysize, xoff:xoff + xsize])
+    out = np.full((ysize, xsize), np.nan, dtype=layer.dtype)
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1, y1 = min(xoff + xsize, layer.shape[1]), min(yoff + ysize, layer.shape[0])
+    if x1 > x0 and y1 > y0:
+        out[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = layer[y0:y1, x0:x1]
+    return out
+
+
+def calculate_cube_stats(cube_dir, gdf, NoDataValue, mask_value, maskit=True, backend='index', query=None):
+    """Calculate the same statistics as calculate_zonal_stats (with
+    observations), reading from a cube built by build_cube instead of the
+    source rasters.
+
+    Arguments
+    ---------
+    cube_dir : str
+        The cube directory.
+    (all others)
+        See calculate_zonal_stats. gdf, NoDataValue, mask_value, maskit and
+        query must match the cube, as NoData and masked pixels are already NaN
+        in it and only the window of its polygons and the queried imagery is
+        in it.
+
+    Returns
+    -------
+    gdf2 : a :class:`geopandas.geodataframe` that conains all statstics for all
+    ploygons and all imagery in the cube.
+    """
+    cube = load_cube(cube_dir)
+    settings = [NoDataValue, [str(item) for item in mask_value] if maskit else None, bool(maskit)]
+    if settings != [cube['NoDataValue'], cube['mask_value'], cube['maskit']]:
+        raise ValueError("The cube in " + cube_dir + " was built with other NoDataValue/mask_value "
+                         "settings, build it again with build_cube")
+    if json.loads(json.dumps(query)) != cube.get('query'):
+        raise ValueError("The cube in " + cube_dir + " was built for another date range, bbox or "
+                         "band, build it again with build_cube")
+    geoms = list(gdf['geometry'])
+    if hash_geoms(geoms) != cube.get('geom_hash'):
+        raise ValueError("The cube in " + cube_dir + " was built for other polygons, build it again "
+                         "with build_cube")
+    zones = get_zones(geoms, tuple(cube['geotransform']), maskit)
+    zonelist = []
+    print("Processing cube...")
+    dates = pd.to_datetime(cube['dates'])
+    for t, date in enumerate(tqdm(dates)):
+        MRO = read_cube_window(cube['data'][t], zones['union'])
+        OBS = None
+        if cube['obs'] is not None:
+            OBS = read_cube_window(cube['obs'][t], zones['union'])
+        statlist = zone_stats(MRO, zones, np.nan, STATS, OBS, backend=backend)
+        for idx, statout in enumerate(statlist):
+            statout['geometry'] = geoms[idx]
+            statout['ID'] = idx + 1
+            statout['date'] = date
+            statout['image'] = cube['files'][t]
+            if 'observations' in statout:
+                statout['observations'] = statout.pop('observations')
+            zonelist.append(statout)
+    gdf2 = gpd.GeoDataFrame(zonelist)
+    return gdf2
+
+
+def write_partitions(gdf2, output_dir, prefix, output_format='csv', geometry_table=None, workers=4):
+    """Write the statistics of each polygon to its own file.  The results are
+    grouped by ID once and the files are written by a pool of threads.
+
+    Arguments
+    ---------
+    gdf2 : a :class:`geopandas.geodataframe`
+        Statistics as returned by calculate_zonal_stats.
+    output_dir : str
+        The directory to write to, created if it does not exist.
+    prefix : str
+        File names are prefix + ID + '.csv' (or '.parquet').
+    output_format : str
+        'csv' (default) or 'parquet'.
+    geometry_table : str
+        Optional. The geometry table relative to output_dir, see write_parquet.
+    workers : int
+        The number of files written at once. Defaults to 4.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    def write(partition):
+        item, gdf3 = partition
+        output = os.path.join(output_dir, prefix + str(item) + '.' + output_format)
+        if output_format == 'parquet':
+            write_parquet(gdf3, output, geometry_table)
+        else:
+            gdf3.to_csv(output)
+
+    pool = ThreadPool(workers)
+    try:
+        for _ in pool.imap_unordered(write, gdf2.groupby('ID', sort=False)):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_geometry_table(gdf, output):
+    """Write the polygons of interest once, keyed by the ID used in the
+    statistics output, as a GeoParquet file.
+
+    Arguments
+    ---------
+    gdf : a :class:`geopandas.geodataframe`
+        The polygons of interest, as passed to calculate_zonal_stats.
+    output : str
+        The path of the parquet file.
+    """
+    geometry = gpd.GeoDataFrame({'ID': np.arange(1, len(gdf) + 1)},
+                                geometry=list(gdf['geometry']), crs=gdf.crs)
+    geometry.to_parquet(output, index=False)
+
+
+def write_parquet(gdf2, output, geometry_table=None):
+    """Write statistics to a parquet file with typed columns. The geometry
+    column is dropped, the name of the geometry table (see
+    write_geometry_table) is kept in the file metadata instead so read_stats
+    can join it back.
+
+    Arguments
+    ---------
+    gdf2 : a :class:`geopandas.geodataframe`
+        Statistics as returned by calculate_zonal_stats.
+    output : str
+        The path of the parquet file.
+    geometry_table : str
+        Optional. The file name of the geometry table, relative to output.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    df = pd.DataFrame(gdf2.drop(columns='geometry', errors='ignore'))
+    df['date'] = pd.to_datetime(df['date'])
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if geometry_table:
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'CometTS_geometry'] = geometry_table.encode()
+        table = table.replace_schema_metadata(metadata)
+    pq.write_table(table, output)
+
+
+def read_stats(path, columns=None, geometry=False):
+    """Read statistics output by run_comet, either csv or parquet.
+
+    Arguments
+    ---------
+    path : str
+        The path to a FullStats or Stats_ID file, csv or parquet.
+    columns : list
+        Optional. Only read these columns, others are never parsed. Columns
+        that are not in the file are ignored.
+    geometry : bool
+        Return a :class:`geopandas.geodataframe` with the polygon of each ID
+        as geometry. Defaults to ``False``, which leaves csv geometry as WKT
+        text and does not read the geometry table of parquet files.
+
+    Returns
+    -------
+    df : a :class:`pandas.DataFrame` or :class:`geopandas.geodataframe`
+        The statistics.
+    """
+    if not path.endswith('.parquet'):
+        if columns is None:
+            df = pd.read_csv(path)
+        else:
+            df = pd.read_csv(path, usecols=lambda column: column in columns)
+        if geometry and 'geometry' in df.columns:
+            df = gpd.GeoDataFrame(df, geometry=df['geometry'].map(shapely.wkt.loads))
+        return df
+
+    import pyarrow.parquet as pq
+    schema = pq.read_schema(path)
+    if columns is not None:
+        columns = [column for column in schema.names if column in columns]
+    df = pq.read_table(path, columns=columns).to_pandas()
+    metadata = schema.metadata or {}
+    if geometry and b'CometTS_geometry' in metadata:
+        geometry_table = os.path.join(os.path.dirname(path), metadata[b'CometTS_geometry'].decode())
+        geoms = gpd.read_parquet(geometry_table)
+        df = gpd.GeoDataFrame(df.merge(geoms, on='ID', how='left'), geometry='geometry', crs=geoms.crs)
+    return df
+
+
 def get_extent(raster):
     """Get the extent of a raster image.
 
@@ -293,6 +1940,183 @@ def get_extent(raster):
     rasterExtent = [minx, maxy, maxx, miny]
     return rasterExtent
 
+
+def get_raster_info(raster):
+    """Read the header of a raster image for the catalog.
+
+    Arguments
+    ---------
+    raster : str
+        The specific path to a raster of interest.
+
+    Returns
+    -------
+    info : dict
+        'extent' as get_extent returns it, and the RASTER_INFO fields: the
+        bounds (minx, miny, maxx, maxy), CRS (as a string), width and height in
+        pixels, dtype, block size and nodata value of the first band.
+    """
+    with rasterio.open(raster) as src:
+        rastergeo = src.transform.to_gdal()
+        minx = rastergeo[0]
+        maxy = rastergeo[3]
+        maxx = minx + rastergeo[1] * src.width
+        miny = maxy + rastergeo[5] * src.height
+        blockysize, blockxsize = src.block_shapes[0]
+        return {'extent': [minx, maxy, maxx, miny],
+                'minx': min(minx, maxx), 'miny': min(miny, maxy),
+                'maxx': max(minx, maxx), 'maxy': max(miny, maxy),
+                'crs': src.crs.to_string() if src.crs else None,
+                'width': src.width, 'height': src.height, 'dtype': src.dtypes[0],
+                'blockxsize': blockxsize, 'blockysize': blockysize, 'nodata': src.nodata}
+
+
+def write_catalog(gdf, output):
+    """Write a catalog from csv_it to an indexed SQLite database, so runs over a
+    date range, region or band only read the matching rows (see read_catalog).
+
+    The 'catalog' table has typed columns, an index on date and band, and the
+    extents are kept in the 'catalog_extent' R-tree.
+
+    Arguments
+    ---------
+    gdf : a :class:`geopandas.geodataframe`
+        The catalog output by csv_it or ls_csv_it.
+    output : str
+        The path of the database, i.e. Raster_List.sqlite.  Replaced if it exists.
+    """
+    if os.path.exists(output):
+        os.remove(output)
+    dates = pd.to_datetime(gdf['date'])
+    # Dates as the csv writes them, so the text sorts and compares by time
+    date_format = '%Y-%m-%d' if (dates == dates.dt.normalize()).all() else '%Y-%m-%d %H:%M:%S'
+    columns = ['File', 'extent', 'date', 'obs', 'TS_Data', 'band_num', 'Mask'] + RASTER_INFO
+    types = dict(CATALOG_TYPES, File='TEXT NOT NULL', extent='TEXT', date='TEXT NOT NULL',
+                 band_num='TEXT', Mask='TEXT')
+    con = sqlite3.connect(output)
+    try:
+        con.execute("CREATE TABLE catalog (id INTEGER PRIMARY KEY, "
+                    + ", ".join(column + " " + types[column] for column in columns) + ")")
+        con.execute("CREATE VIRTUAL TABLE catalog_extent USING rtree(id, minx, maxx, miny, maxy)")
+        rows, extents = [], []
+        for idx, (row, date) in enumerate(zip(gdf.to_dict('records'), dates.dt.strftime(date_format))):
+            extent = row.get('extent')
+            if isinstance(extent, str):
+                extent = json.loads(extent)
+            values = dict((column, row.get(column)) for column in columns)
+            values['extent'] = None if extent is None else str(list(extent))
+            values['date'] = date
+            if values['band_num'] is not None and not pd.isnull(values['band_num']):
+                values['band_num'] = str(values['band_num'])
+            if extent is not None and pd.isnull(values['minx']):
+                # Catalogs from before the typed columns only have the extent
+                minx, maxy, maxx, miny = extent
+                values.update(minx=min(minx, maxx), miny=min(miny, maxy), maxx=max(minx, maxx), maxy=max(miny, maxy))
+            for column, value in values.items():
+                if isinstance(value, float) and np.isnan(value):
+                    values[column] = None
+                elif isinstance(value, np.generic):
+                    values[column] = value.item()
+            rows.append([idx] + [values[column] for column in columns])
+            if values['minx'] is not None:
+                extents.append((idx, values['minx'], values['maxx'], values['miny'], values['maxy']))
+        con.executemany("INSERT INTO catalog VALUES (" + ", ".join("?" * (len(columns) + 1)) + ")", rows)
+        con.executemany("INSERT INTO catalog_extent VALUES (?, ?, ?, ?, ?)", extents)
+        con.execute("CREATE INDEX catalog_date ON catalog (date)")
+        con.execute("CREATE INDEX catalog_band ON catalog (band_num)")
+        con.commit()
+    finally:
+        con.close()
+
+
+def read_catalog(directory_csv, query=None):
+    """Read the catalog of a run, a csv from csv_it or a database from
+    write_catalog, with typed columns and keeping only the rows that match a
+    query.  Database queries are answered from its indexes without reading the
+    other rows.
+
+    Arguments
+    ---------
+    directory_csv : str
+        The csv or database (.sqlite or .db) documenting your raster data.
+    query : dict
+        Optional. Any of 'start_date' and 'end_date' (inclusive, i.e.
+        '2017-01-01'), 'bbox' (minx, miny, maxx, maxy, in the CRS of the
+        imagery) and 'band' (a band_num, or a list or comma separated string of
+        them).  Observations and rasters without a band or extent are never
+        filtered out by band or bbox.
+
+    Returns
+    -------
+    data : a :class:`pandas.DataFrame`
+        The matching rows with the columns of the csv, in catalog order.  Dates
+        are datetime64 and the RASTER_INFO columns, if the catalog has them,
+        are typed as in CATALOG_TYPES.
+    """
+    query = dict((key, value) for key, value in (query or {}).items() if value is not None)
+    start, end = query.get('start_date'), query.get('end_date')
+    start = pd.Timestamp(start).normalize() if start is not None else None
+    end = pd.Timestamp(end).normalize() + pd.Timedelta(days=1) if end is not None else None
+    bbox, band = query.get('bbox'), query.get('band')
+    if band is not None:
+        band = [str(item).strip() for item in (band.split(',') if isinstance(band, str) else band)]
+
+    if directory_csv.endswith(('.sqlite', '.db')):
+        where, params = [], []
+        if start is not None:
+            where.append("date >= ?")
+            params.append(start.strftime('%Y-%m-%d'))
+        if end is not None:
+            where.append("date < ?")
+            params.append(end.strftime('%Y-%m-%d'))
+        if band is not None:
+            where.append("(TS_Data IS NOT 1 OR band_num IS NULL OR band_num IN ("
+                         + ", ".join("?" * len(band)) + "))")
+            params.extend(band)
+        if bbox is not None:
+            where.append("(minx IS NULL OR id IN (SELECT id FROM catalog_extent "
+                         "WHERE maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ?))")
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        sql = "SELECT * FROM catalog"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        con = sqlite3.connect(directory_csv)
+        try:
+            data = pd.read_sql_query(sql + " ORDER BY id", con, params=params, parse_dates=['date'])
+        finally:
+            con.close()
+        # Leave out the columns the catalog did not have
+        data = data.drop(columns=['id'] + [column for column in ['band_num', 'Mask'] + RASTER_INFO
+                                           if data[column].isnull().all()])
+    else:
+        data = pd.read_csv(directory_csv, parse_dates=['date'],
+                           dtype={'File': str, 'Mask': str, 'extent': str, 'band_num': str,
+                                  'crs': str, 'dtype': str})
+        if start is not None:
+            data = data[data['date'] >= start]
+        if end is not None:
+            data = data[data['date'] < end]
+        if band is not None and 'band_num' in data.columns:
+            data = data[(data['TS_Data'] != 1) | data['band_num'].isnull() | data['band_num'].isin(band)]
+        if bbox is not None and 'extent' in data.columns:
+            if 'minx' in data.columns:
+                bounds = data[['minx', 'miny', 'maxx', 'maxy']]
+            else:
+                extents = [json.loads(extent) if isinstance(extent, str) else [np.nan] * 4
+                           for extent in data['extent']]
+                extents = np.array(extents, dtype='float64').reshape(-1, 4)
+                bounds = pd.DataFrame({'minx': np.minimum(extents[:, 0], extents[:, 2]),
+                                       'miny': np.minimum(extents[:, 1], extents[:, 3]),
+                                       'maxx': np.maximum(extents[:, 0], extents[:, 2]),
+                                       'maxy': np.maximum(extents[:, 1], extents[:, 3])}, index=data.index)
+            overlaps = ((bounds['maxx'] >= bbox[0]) & (bounds['minx'] <= bbox[2])
+                        & (bounds['maxy'] >= bbox[1]) & (bounds['miny'] <= bbox[3]))
+            data = data[bounds['minx'].isnull() | overlaps]
+    for column, dtype in CATALOG_TYPES.items():
+        if column in data.columns and dtype == 'INTEGER' and data[column].notnull().all():
+            data[column] = data[column].astype('int64')
+    return data
+
 ###############################################################################
 
 
@@ -306,21 +2130,53 @@ def main():
 
     # general settings
     parser.add_argument('--input_csv', type=str, default=List,
-                        help="Enter csv to data - default: " + List)
+                        help="Enter csv (or SQLite catalog) to data - default: " + List)
     parser.add_argument('--zonalpoly', type=str, default=Poly,
                         help="Enter full path to vector polygon - default: " + Poly)
     parser.add_argument('--NoDataValue', type=str, default=-1,
                         help="Default is -1. Enter NoData Value for null space in imagery(ex: Landsat typically -9999, VIIRS Monthly Composites -1)")
     parser.add_argument('--mask_value', type=str, default=0,
-                        help="Default is 0. Enter mask pixel value(s).  (ex: Clouds/Cloud Shadow=1), If multiple values seperate with a comma (i.e. 1,2,99) if no masking is required, leave blank")
+                        help="Default is 0. Enter mask pixel value(s).  (ex: Clouds/Cloud Shadow=1), If multiple values seperate with a comma (i.e. 1,2,99) if no masking is required, leave blank. For a Landsat pixel_qa mask QA bit rules can be used (i.e. cloud,shadow,snow,cloud_confidence>=medium)")
     parser.add_argument('--maskit', type=bool, default=True,
                         help="Turn masking functionality on or off, default is true.  Set to false to turn off.")
     parser.add_argument('--Path_out', type=str, default="",
                         help="Add an output path for CSVs.  Default is the same directory as the input_csv")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Default is 1. Number of processes to split the imagery across by date.")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help="Optional directory to cache rasterized polygons in, reused by repeat runs.")
+    parser.add_argument('--backend', type=str, default='index', choices=['index', 'label'],
+                        help="Default is index. Use label for thousands of non-overlapping polygons.")
+    parser.add_argument('--result_cache', type=str, default=None,
+                        help="Optional directory to keep results in, so re-runs only process new imagery.")
+    parser.add_argument('--output_format', type=str, default='csv', choices=['csv', 'parquet'],
+                        help="Default is csv. Parquet stores typed columns and each polygon only once.")
+    parser.add_argument('--stream', action='store_true',
+                        help="Write FullStats as imagery is processed, with flat memory use. Skips per ID files.")
+    parser.add_argument('--cube', type=str, default=None,
+                        help="Optional data cube directory to read imagery from, built on first use.")
+    parser.add_argument('--per_id', type=str, default='files', choices=['files', 'dataset', 'none'],
+                        help="Default is files, one per polygon ID in Path_out. Use dataset for one directory of ID files, or none to skip them.")
+    parser.add_argument('--start_date', type=str, default=None,
+                        help="Optional. Only process imagery on or after this date, i.e. 2017-01-01.")
+    parser.add_argument('--end_date', type=str, default=None,
+                        help="Optional. Only process imagery on or before this date, i.e. 2017-12-31.")
+    parser.add_argument('--bbox', type=str, default=None,
+                        help="Optional. Only process imagery overlapping minx,miny,maxx,maxy, in the imagery CRS.")
+    parser.add_argument('--band', type=str, default=None,
+                        help="Optional. Only process imagery with this band_num in the catalog, or several split by commas (i.e. RED,NIR).")
+    parser.add_argument('--band_math', type=str, nargs='+', default=None,
+                        help="Optional. Band math to calculate from a multi-band catalog instead of the bands, presets (NDVI, NDBI, NDWI) or expressions (i.e. 'SR=NIR / RED').")
 
     args = parser.parse_args()
 
-    run_comet(args.input_csv, args.zonalpoly, args.NoDataValue, args.mask_value, maskit=args.maskit, Path_out=args.Path_out)
+    run_comet(args.input_csv, args.zonalpoly, args.NoDataValue, args.mask_value, maskit=args.maskit,
+              Path_out=args.Path_out, workers=args.workers, cache_dir=args.cache_dir, backend=args.backend,
+              result_cache=args.result_cache, output_format=args.output_format,
+              per_id=args.per_id, stream=args.stream,
+              cube=args.cube, start_date=args.start_date, end_date=args.end_date,
+              bbox=[float(item) for item in args.bbox.split(',')] if args.bbox else None,
+              band=args.band, band_math=args.band_math)
     print("Run Plot_Results.ipynb to generate visualizations from output CSV")
 
 
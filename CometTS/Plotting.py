@@ -1,7 +1,6 @@
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-import shapely.wkt
+from CometTS.CometTS import read_stats
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from scipy.signal import gaussian
@@ -12,6 +11,9 @@ provided but these are simple wrappers around matplotlib.  Simple adjustments to
 what you pass to each function should enable easy modification of output plots.
 """
 
+# The only columns the plots use, others are not read from csv or parquet
+PLOT_COLUMNS = ['ID', 'date', 'count', 'median', 'percentile_25', 'percentile_75', 'observations']
+
 
 def interpolate_gaps(values, limit=None):
     """When there are gaps in the data they sometimes cannot be plotted properly.
@@ -711,12 +713,9 @@ def run_tri_plot(
 
 
 def gen_plots(input_csv):
-    # Run plotting from CSV output ONLY
-    df = pd.read_csv(input_csv)
-    df = df.sort_values(['date'])
-    geometry = df['geometry'].map(shapely.wkt.loads)
-    crs = {'init': 'epsg:2263'}
-    gdf = gpd.GeoDataFrame(df, crs=crs, geometry=geometry)
+    # Run plotting from CSV or parquet output ONLY
+    df = read_stats(input_csv, columns=PLOT_COLUMNS)
+    gdf = df.sort_values(['date'])
     gdf['date'] = pd.to_datetime(gdf['date'], infer_datetime_format=True)
     run_plot(gdf)
 
@@ -729,11 +728,8 @@ def gen_dual_plot(
     gdfs = ["gdf_1", "gdf_2"]
     count = 0
     for csv in CSVs:
-        df = pd.read_csv(csv)
-        df = df.sort_values(['date'])
-        geometry = df['geometry'].map(shapely.wkt.loads)
-        crs = {'init': 'epsg:2263'}
-        gdfs[count] = gpd.GeoDataFrame(df, crs=crs, geometry=geometry)
+        df = read_stats(csv, columns=PLOT_COLUMNS)
+        gdfs[count] = df.sort_values(['date'])
         gdfs[count]['date'] = pd.to_datetime(
             gdfs[count]['date'], infer_datetime_format=True)
         count += 1
@@ -755,11 +751,8 @@ def gen_tri_plot(
     gdfs = ["gdf_1", "gdf_2", "gdf_3"]
     count = 0
     for csv in CSVs:
-        df = pd.read_csv(csv)
-        df = df.sort_values(['date'])
-        geometry = df['geometry'].map(shapely.wkt.loads)
-        crs = {'init': 'epsg:2263'}
-        gdfs[count] = gpd.GeoDataFrame(df, crs=crs, geometry=geometry)
+        df = read_stats(csv, columns=PLOT_COLUMNS)
+        gdfs[count] = df.sort_values(['date'])
         gdfs[count]['date'] = pd.to_datetime(
             gdfs[count]['date'], infer_datetime_format=True)
         count += 1
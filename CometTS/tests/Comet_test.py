@@ -1,7 +1,17 @@
 import os
-from CometTS.CometTS import run_comet
+import shutil
+import warnings
+import tempfile
+from multiprocessing.pool import ThreadPool
+from CometTS.CometTS import run_comet, mask_imagery, calculate_raster_stats, calculate_zonal_stats, stream_zonal_stats, read_stats, read_catalog, parse_band_math, mask_lut, mask_pixels, build_cube, calculate_cube_stats, STATS
+from rasterstats import zonal_stats
+from shapely.affinity import translate
+import geopandas as gpd
+from CometTS import CSV_It
 from CometTS.CSV_It import csv_it
-from CometTS.ARIMA import run_arima
+from CometTS.ARIMA import run_arima, timeseries_trend, pixel_trend, batch_trend, update_arima, cutoff_sweep, batch_sarima
+import pytest
+import numpy as np
 import pandas as pd
 
 """Pytest evaluations.  These only test the single band processing,
@@ -14,6 +24,14 @@ data_dir = os.path.join(os.getcwd(), "VIIRS_Sample")
 print(data_dir)
 
 
+def sample_catalog(out):
+    """Catalog the sample imagery with csv_it into a csv in out, so a test does
+    not rely on test_csv_it having rewritten Test_Raster_List2.csv first."""
+    catalog = os.path.join(str(out), "Raster_List.csv")
+    csv_it(input_dir=data_dir, TSdata="S*rade9*.tif", Observations="S*cvg*.tif", Mask="S*cvg*.tif", DateLoc="10:18", BandNum="").to_csv(catalog)
+    return catalog
+
+
 class TestEvalBase(object):
     def test_csv_it(self):
         """Test instantiation of csv_it.  Will also test get_extent"""
@@ -30,6 +48,114 @@ class TestEvalBase(object):
         print(base_instance['extent'])
         pd.testing.assert_frame_equal(base_instance.reset_index(drop=True), gdf.reset_index(drop=True))
 
+    def test_csv_it_cache(self, monkeypatch):
+        """Test that cataloguing again reads extents from the cache, not the rasters"""
+        out = tempfile.mkdtemp()
+        try:
+            cache = os.path.join(out, "extents.json")
+            base_instance = csv_it(input_dir=data_dir, TSdata="S*rade9*.tif", Observations="S*cvg*.tif", Mask="S*cvg*.tif", DateLoc="10:18", BandNum="", cache=cache)
+
+            def get_raster_info(raster):
+                raise AssertionError(raster + " was read again")
+            monkeypatch.setattr(CSV_It, "get_raster_info", get_raster_info)
+            cached = csv_it(input_dir=data_dir, TSdata="S*rade9*.tif", Observations="S*cvg*.tif", Mask="S*cvg*.tif", DateLoc="10:18", BandNum="", cache=cache)
+        finally:
+            shutil.rmtree(out)
+        pd.testing.assert_frame_equal(base_instance, cached)
+
+    def test_catalog(self):
+        """Test that a date range query on the SQLite catalog matches the full run"""
+        out = tempfile.mkdtemp()
+        try:
+            catalog = os.path.join(out, "Raster_List.sqlite")
+            csv_it(input_dir=data_dir, TSdata="S*rade9*.tif", Observations="S*cvg*.tif", Mask="S*cvg*.tif", DateLoc="10:18", BandNum="", catalog=catalog)
+            gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+            query = {'start_date': '2017-01-01', 'end_date': '2017-06-30'}
+            assert len(read_catalog(catalog, query)) == 12
+            gdf2 = calculate_zonal_stats(catalog, gdf, -1, ['0'], True, observations=True, query=query)
+        finally:
+            shutil.rmtree(out)
+        base = calculate_zonal_stats(os.path.join(data_dir, "Test_Raster_List2.csv"), gdf, -1, ['0'], True, observations=True)
+        base = base[(base['date'] >= '2017-01-01') & (base['date'] <= '2017-06-30')]
+        pd.testing.assert_frame_equal(gdf2.sort_values('date').reset_index(drop=True), base.sort_values('date').reset_index(drop=True))
+
+    def test_catalog_types(self, tmpdir):
+        """Test that catalogs load with typed dates, bounds and raster headers"""
+        data = read_catalog(sample_catalog(tmpdir))
+        assert pd.api.types.is_datetime64_any_dtype(data['date'])
+        assert (data[['minx', 'miny', 'maxx', 'maxy']].dtypes == 'float64').all()
+        assert (data['maxx'] > data['minx']).all() and (data['maxy'] > data['miny']).all()
+        assert set(data['crs']) == {'EPSG:4326'}
+        assert data['width'].dtype == 'int64' and (data['width'] > 0).all()
+
+    def test_multiband(self):
+        """Test that the bands of a multi-band catalog match single band runs"""
+        data = pd.read_csv(os.path.join(data_dir, "Test_Raster_List2.csv"))
+        bands = pd.concat([data[data['TS_Data'] == 1].assign(band_num=band) for band in ("A", "B")])
+        out = tempfile.mkdtemp()
+        try:
+            catalog = os.path.join(out, "Bands.csv")
+            pd.concat([bands, data[data['TS_Data'] != 1]]).to_csv(catalog, index=False)
+            gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+            gdf2 = calculate_zonal_stats(catalog, gdf, -1, ['0'], True, observations=True)
+        finally:
+            shutil.rmtree(out)
+        base = calculate_zonal_stats(os.path.join(data_dir, "Test_Raster_List2.csv"), gdf, -1, ['0'], True, observations=True)
+        base = base.sort_values('date').reset_index(drop=True)
+        for band in ("A", "B"):
+            result = gdf2[gdf2['band'] == band].drop(columns='band').sort_values('date').reset_index(drop=True)
+            pd.testing.assert_frame_equal(result, base)
+
+    def test_band_math(self):
+        """Test band math against the stats of the bands it is calculated from"""
+        data = pd.read_csv(os.path.join(data_dir, "Test_Raster_List2.csv"))
+        bands = pd.concat([data[data['TS_Data'] == 1].assign(band_num=band) for band in ("NIR", "RED")])
+        out = tempfile.mkdtemp()
+        try:
+            catalog = os.path.join(out, "Bands.csv")
+            pd.concat([bands, data[data['TS_Data'] != 1]]).to_csv(catalog, index=False)
+            gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+            gdf2 = calculate_zonal_stats(catalog, gdf, -1, ['0'], True, observations=True,
+                                         band_math=["NDVI", "SUM=NIR + RED"])
+        finally:
+            shutil.rmtree(out)
+        base = calculate_zonal_stats(os.path.join(data_dir, "Test_Raster_List2.csv"), gdf, -1, ['0'], True, observations=True)
+        base = base.sort_values('date').reset_index(drop=True)
+        total = gdf2[gdf2['band'] == "SUM"].sort_values('date').reset_index(drop=True)
+        for stat in ('min', 'max', 'mean', 'median'):
+            np.testing.assert_allclose(total[stat], 2 * base[stat], rtol=1e-6)
+        pd.testing.assert_series_equal(total['count'], base['count'])
+        pd.testing.assert_series_equal(total['observations'], base['observations'])
+        ndvi = gdf2[gdf2['band'] == "NDVI"]
+        assert len(ndvi) == len(base)
+        assert (ndvi['max'].fillna(0) == 0).all()
+        assert parse_band_math("NDVI") == ("NDVI", "(NIR - RED) / (NIR + RED)", ["NIR", "RED"])
+        assert parse_band_math("NIR>=RED") == ("NIR>=RED", "NIR>=RED", ["NIR", "RED"])
+        assert parse_band_math("where(NIR<=0, 0, NIR)") == ("where(NIR<=0, 0, NIR)", "where(NIR<=0, 0, NIR)", ["NIR"])
+        assert parse_band_math(" SR = 2 * NIR / RED") == ("SR", "2 * NIR / RED", ["NIR", "RED"])
+        with pytest.raises(ValueError):
+            parse_band_math("__import__('os').getcwd()")
+
+    def test_mask_lut(self):
+        """Test QA bit rules and mask values against the bits of every QA value"""
+        qa = np.arange(65536, dtype=np.uint16)
+        lut = mask_lut(['cloud', 'shadow', 'cloud_confidence>=medium', '1'])
+        expected = (qa & 32 > 0) | (qa & 8 > 0) | ((qa >> 6) & 3 >= 2) | (qa == 1)
+        np.testing.assert_array_equal(lut, expected)
+        np.testing.assert_array_equal(mask_pixels(qa.reshape(256, 256), ['snow']), (qa & 16 > 0).reshape(256, 256))
+        MR2 = np.array([[-1, 0], [2, 99]], dtype=np.int16)
+        np.testing.assert_array_equal(mask_pixels(MR2, ['-1', '99']), np.isin(MR2, [-1, 99]))
+        np.testing.assert_array_equal(mask_pixels(MR2.astype(np.float32), ['2']), MR2 == 2)
+        # Values the mask can not hold mask nothing, rather than wrapping around
+        MR2 = np.array([[0, 65535], [255, 1]], dtype=np.uint16)
+        assert not mask_pixels(MR2, ['65536', '-1']).any()
+        small = np.array([[0, 255], [1, 255]], dtype=np.uint8)
+        np.testing.assert_array_equal(mask_pixels(small, ['256', '255']), small == 255)
+        signed = np.array([[0, -1], [1, 255]], dtype=np.int16)
+        np.testing.assert_array_equal(mask_pixels(signed, ['-1', '65535']), signed == -1)
+        with pytest.raises(ValueError):
+            mask_lut(['clouds'])
+
     def test_run_comet(self):
         print(data_dir)
         """Test instantiation of run_comet.
@@ -47,6 +173,179 @@ class TestEvalBase(object):
         print(base_instance['mean'])
         pd.testing.assert_frame_equal(base_instance.reset_index(drop=True), gdf.reset_index(drop=True))
 
+    def test_calculate_raster_stats(self, tmpdir):
+        """Test that the single read engine matches rasterstats on each polygon clipped with mask_imagery"""
+        row = pd.read_csv(sample_catalog(tmpdir)).iloc[0]
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        geom = gdf['geometry'][0]
+        MR, affine = mask_imagery(row['File'], row['Mask'], geom, -1, ['0'])
+        expected = zonal_stats(geom, MR, stats=STATS, nodata=-1, affine=affine)
+        statlist = calculate_raster_stats(row['File'], row['Mask'], [geom], -1, ['0'])
+        pd.testing.assert_frame_equal(pd.DataFrame(statlist), pd.DataFrame(expected))
+        labelled = calculate_raster_stats(row['File'], row['Mask'], [geom], -1, ['0'], backend='label')
+        pd.testing.assert_frame_equal(pd.DataFrame(labelled), pd.DataFrame(expected))
+
+    def test_threaded_raster_stats(self):
+        """Test that calculate_raster_stats in a thread pool matches serial runs"""
+        data = pd.read_csv(os.path.join(data_dir, "Test_Raster_List2.csv"))
+        rows = data[data['TS_Data'] == 1].to_dict('records') * 4
+        geoms = list(gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))['geometry'])
+
+        def job(row):
+            return calculate_raster_stats(row['File'], row['Mask'], geoms, -1, ['0'], obs=row['File'])
+
+        serial = [job(row) for row in rows]
+        pool = ThreadPool(8)
+        try:
+            threaded = pool.map(job, rows)
+        finally:
+            pool.close()
+        assert threaded == serial
+
+    def test_workers(self, tmpdir):
+        """Test that a process pool gives the same, identically ordered, output"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        csv = sample_catalog(tmpdir)
+        serial = calculate_zonal_stats(csv, gdf, -1, ['0'])
+        pooled = calculate_zonal_stats(csv, gdf, -1, ['0'], workers=2)
+        pd.testing.assert_frame_equal(pd.DataFrame(serial), pd.DataFrame(pooled))
+
+    def test_prune(self):
+        """Test that polygons outside every raster extent are skipped"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        far = translate(gdf['geometry'][0], xoff=10)
+        gdf = gpd.GeoDataFrame(geometry=[gdf['geometry'][0], far], crs=gdf.crs)
+        csv = os.path.join(data_dir, "Test_Raster_List2.csv")
+        gdf2 = calculate_zonal_stats(csv, gdf, -1, ['0'])
+        assert list(gdf2['ID'].unique()) == [1]
+        assert len(gdf2) == (pd.read_csv(csv)['TS_Data'] == 1).sum()
+
+    def test_result_cache(self):
+        """Test that cached results are reused and only new polygons are calculated"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        csv = os.path.join(data_dir, "Test_Raster_List2.csv")
+        cache = tempfile.mkdtemp()
+        try:
+            gdf1 = calculate_zonal_stats(csv, gdf[:1], -1, ['0'], result_cache=cache)
+            files = sorted(os.listdir(cache))
+            gdf2 = calculate_zonal_stats(csv, gdf, -1, ['0'], result_cache=cache)
+            assert sorted(os.listdir(cache)) == files
+            gdf3 = calculate_zonal_stats(csv, gdf, -1, ['0'])
+        finally:
+            shutil.rmtree(cache)
+        pd.testing.assert_frame_equal(gdf2, gdf3)
+        pd.testing.assert_frame_equal(gdf1, gdf3[gdf3['ID'] == 1].reset_index(drop=True))
+
+    def test_parquet(self):
+        """Test that parquet output reads back with its geometry and runs through ARIMA"""
+        out = tempfile.mkdtemp()
+        try:
+            gdf2 = run_comet(os.path.join(data_dir, "Test_Raster_List2.csv"), os.path.join(data_dir, "San_Juan.shp"), -1, 0, maskit=True, Path_out=out, output_format='parquet', per_id='dataset')
+            output = os.path.join(out, "San_Juan_FullStats.parquet")
+            gdf3 = read_stats(os.path.join(out, "San_Juan_Stats_ID", "1.parquet"), geometry=True)
+            gdf = read_stats(output, geometry=True)
+            assert sorted(read_stats(output, columns=['ID', 'mean']).columns) == ['ID', 'mean']
+            run_arima(output, os.path.join(out, "ARIMA.csv"), 3, "2017/08/15", 2)
+            arima = pd.read_csv(os.path.join(out, "ARIMA.csv"))
+        finally:
+            shutil.rmtree(out)
+        assert all(gdf['geometry'].geom_equals(gdf2['geometry']))
+        assert all(gdf3['geometry'].geom_equals(gdf2['geometry']))
+        pd.testing.assert_series_equal(gdf['mean'], gdf2['mean'])
+        base = pd.read_csv(os.path.join(data_dir, "Test_San_Juan_ARIMA_Output.csv")).sort_values(by=['date'])
+        pd.testing.assert_series_equal(arima['SeasonalForecast'].reset_index(drop=True), base['SeasonalForecast'].reset_index(drop=True))
+
+    def test_stream(self, tmpdir):
+        """Test that streamed output matches the in memory results, whatever the batch size"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        csv = sample_catalog(tmpdir)
+        out = tempfile.mkdtemp()
+        try:
+            rows = stream_zonal_stats(csv, gdf, os.path.join(out, "stream.csv"), -1, ['0'], observations=True, batch_size=1)
+            stream = pd.read_csv(os.path.join(out, "stream.csv"))
+        finally:
+            shutil.rmtree(out)
+        gdf2 = calculate_zonal_stats(csv, gdf, -1, ['0'], observations=True)
+        assert rows == len(gdf2)
+        pd.testing.assert_series_equal(stream['mean'], gdf2['mean'])
+        pd.testing.assert_series_equal(stream['observations'], gdf2['observations'])
+
+    def test_stream_mixed_obs(self, tmpdir):
+        """Test streaming a catalog where the first date has no observation raster"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        data = pd.read_csv(sample_catalog(tmpdir))
+        first = data['date'].min()
+        csv = os.path.join(str(tmpdir), "Mixed.csv")
+        data[~((data['obs'] == 1) & (data['date'] == first))].to_csv(csv, index=False)
+        gdf2 = calculate_zonal_stats(csv, gdf, -1, ['0'], observations=True)
+        assert gdf2['observations'].isnull().sum() == 1
+        for output in ("stream.csv", "stream.parquet"):
+            output = os.path.join(str(tmpdir), output)
+            stream_zonal_stats(csv, gdf, output, -1, ['0'], observations=True, batch_size=1)
+            stream = read_stats(output)
+            columns = [column for column in stream.columns if column not in ('Unnamed: 0', 'geometry')]
+            assert columns == list(gdf2.drop(columns='geometry').columns)
+            pd.testing.assert_series_equal(stream['mean'], gdf2['mean'])
+            pd.testing.assert_series_equal(stream['observations'], gdf2['observations'])
+
+    def test_cube(self):
+        """Test that stats read from a data cube match those read from the rasters"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        csv = os.path.join(data_dir, "Test_Raster_List2.csv")
+        cube_dir = tempfile.mkdtemp()
+        try:
+            cube = build_cube(csv, gdf, cube_dir, -1, ['0'])
+            assert cube['data'].shape[0] == (pd.read_csv(csv)['TS_Data'] == 1).sum()
+            gdf2 = calculate_cube_stats(cube_dir, gdf, -1, ['0'])
+        finally:
+            shutil.rmtree(cube_dir)
+        gdf3 = calculate_zonal_stats(csv, gdf, -1, ['0'], observations=True)
+        pd.testing.assert_frame_equal(pd.DataFrame(gdf2.drop(columns='geometry')), pd.DataFrame(gdf3.drop(columns='geometry')))
+
+    def test_multiband_cube(self):
+        """Test that a cube is only built for one band of a multi-band catalog"""
+        data = pd.read_csv(os.path.join(data_dir, "Test_Raster_List2.csv"))
+        bands = pd.concat([data[data['TS_Data'] == 1].assign(band_num=band) for band in ("A", "B")])
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        out = tempfile.mkdtemp()
+        try:
+            catalog = os.path.join(out, "Bands.csv")
+            pd.concat([bands, data[data['TS_Data'] != 1]]).to_csv(catalog, index=False)
+            with pytest.raises(ValueError):
+                build_cube(catalog, gdf, os.path.join(out, "cube"), -1, ['0'])
+            cube = build_cube(catalog, gdf, os.path.join(out, "cube"), -1, ['0'], query={'band': 'A'})
+            assert cube['data'].shape[0] == (data['TS_Data'] == 1).sum()
+        finally:
+            shutil.rmtree(out)
+
+    def test_stale_cube(self):
+        """Test that a cube is not reused for other polygons or a changed catalog"""
+        gdf = gpd.read_file(os.path.join(data_dir, "San_Juan.shp"))
+        shifted = gdf.copy()
+        shifted['geometry'] = shifted['geometry'].apply(lambda geom: translate(geom, 0.3, -0.3))
+        out = tempfile.mkdtemp()
+        try:
+            csv = os.path.join(out, "Raster_List.csv")
+            shutil.copy(os.path.join(data_dir, "Test_Raster_List2.csv"), csv)
+            shp = os.path.join(out, "Shifted.shp")
+            shifted.to_file(shp)
+            cube_dir = os.path.join(out, "cube")
+            build_cube(csv, gdf, cube_dir, -1, ['0'])
+            with pytest.raises(ValueError):
+                calculate_cube_stats(cube_dir, shifted, -1, ['0'])
+            # run_comet builds the cube again for the shifted polygons
+            gdf2 = run_comet(csv, shp, -1, 0, Path_out=out, cube=cube_dir, per_id='none')
+            gdf3 = calculate_zonal_stats(csv, shifted, -1, ['0'], observations=True)
+            assert (gdf3['count'] > 0).all()
+            pd.testing.assert_frame_equal(pd.DataFrame(gdf2.drop(columns='geometry')), pd.DataFrame(gdf3.drop(columns='geometry')))
+            # and again when imagery is dropped from (or added to) the catalog
+            data = pd.read_csv(csv)
+            data.drop(index=data[data['TS_Data'] == 1].index[-1]).to_csv(csv, index=False)
+            gdf4 = run_comet(csv, shp, -1, 0, Path_out=out, cube=cube_dir, per_id='none')
+            assert len(gdf4) == len(gdf2) - 1
+        finally:
+            shutil.rmtree(out)
+
     def test_ARIMA(self):
         """Test instantiation of ARIMA Functions."""
         run_arima(os.path.join(data_dir, "Test_San_Juan_FullStats2.csv"), os.path.join(data_dir, "Test_San_Juan_ARIMA_Output2.csv"), 3, "2017/08/15", 2)
@@ -59,3 +358,118 @@ class TestEvalBase(object):
         print(gdf['SeasonalForecast'])
         print(base_instance['SeasonalForecast'])
         pd.testing.assert_frame_equal(base_instance.reset_index(drop=True), gdf.reset_index(drop=True))
+
+    def test_pixel_trend(self):
+        """Test that the per pixel trend matches timeseries_trend on a single series"""
+        df = pd.read_csv(os.path.join(data_dir, "San_Juan_FullStats.csv")).sort_values(by=['date'])
+        gdf = timeseries_trend(df.copy(), 3, "2017/08/15", 2).sort_values(by=['date'])
+        trend = pixel_trend(df['mean'].values[:, None, None], list(df['date']), 3, "2017/08/15", 2)
+        forecast = pd.Series(trend['SeasonalForecast'][:, 0, 0], index=df['date'].values)
+        np.testing.assert_allclose(forecast.loc[gdf['date']].values, gdf['SeasonalForecast'].values)
+        assert (trend['Anomaly'] != 0).sum() == gdf['Anomaly'].notna().sum()
+        # One point to fit the trend through, next to a pixel without any data
+        df = df.reset_index(drop=True)
+        pre = df.index[df['date'] <= "2017-08-15"]
+        df.loc[pre[:5].union(pre[8:]), 'mean'] = np.nan
+        gdf = timeseries_trend(df.copy(), 3, "2017/08/15", 2).sort_values(by=['date'])
+        stack = np.stack([df['mean'].values, np.full(len(df), np.nan)], axis=1)[:, :, None]
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            trend = pixel_trend(stack, list(df['date']), 3, "2017/08/15", 2)
+        forecast = pd.Series(trend['SeasonalForecast'][:, 0, 0], index=df['date'].values)
+        np.testing.assert_allclose(forecast.loc[gdf['date']].values, gdf['SeasonalForecast'].values)
+        assert np.isnan(trend['Slope'][1, 0])
+
+    def test_batch_trend(self):
+        """Test that the batched trend of several IDs matches timeseries_trend per ID"""
+        df = pd.read_csv(os.path.join(data_dir, "San_Juan_FullStats.csv"))
+        df2 = df.assign(ID=2, mean=df['mean'] * 2 + 1)
+        main_gdf = pd.concat([df2, df[::2]], ignore_index=True)
+        gdf = batch_trend(main_gdf, 3, "2017/08/15", 2)
+        for item in [2, 1]:
+            base = main_gdf[main_gdf.ID == item].sort_values(['date'])
+            base = timeseries_trend(base, 3, "2017/08/15", 2).sort_values(['date'])
+            pd.testing.assert_frame_equal(gdf[gdf.ID == item], base)
+
+    def test_trend_bands(self):
+        """Test that statistics of several bands are refused rather than fit as one series"""
+        df = pd.read_csv(os.path.join(data_dir, "San_Juan_FullStats.csv"))
+        bands = pd.concat([df.assign(band="NIR"), df.assign(band="RED", mean=df['mean'] * 2)], ignore_index=True)
+        for model in (batch_trend, batch_sarima):
+            with pytest.raises(ValueError):
+                model(bands)
+        with pytest.raises(ValueError):
+            cutoff_sweep(bands, ["2017/08/15"])
+        gdf = batch_trend(bands[bands['band'] == "NIR"], 3, "2017/08/15", 2)
+        base = batch_trend(df, 3, "2017/08/15", 2)
+        pd.testing.assert_frame_equal(gdf.drop(columns='band'), base)
+
+    def test_update_arima(self):
+        """Test that scoring new dates with a saved model state matches a full refit"""
+        df = pd.read_csv(os.path.join(data_dir, "San_Juan_FullStats.csv"))
+        out = tempfile.mkdtemp()
+        try:
+            df[df['date'] <= "2017-12-01"].to_csv(os.path.join(out, "old.csv"))
+            df[df['date'] > "2017-12-01"].to_csv(os.path.join(out, "new.csv"))
+            state = os.path.join(out, "state.npz")
+            run_arima(os.path.join(out, "old.csv"), os.path.join(out, "old_ARIMA.csv"), 3, "2017/08/15", 2, state)
+            gdf = update_arima(state, os.path.join(out, "new.csv"), os.path.join(out, "new_ARIMA.csv"))
+        finally:
+            shutil.rmtree(out)
+        base = batch_trend(df, 3, "2017/08/15", 2)
+        base = base[base['date'] > "2017-12-01"]
+        pd.testing.assert_series_equal(gdf['Anomaly'].reset_index(drop=True), base['Anomaly'].reset_index(drop=True))
+        pd.testing.assert_series_equal(gdf['SeasonalForecast'].reset_index(drop=True), base['SeasonalForecast'].reset_index(drop=True))
+
+    def test_update_arima_text_ids(self):
+        """Test that a model state of polygons with text IDs can be saved and used"""
+        df = pd.read_csv(os.path.join(data_dir, "San_Juan_FullStats.csv"))
+        df = pd.concat([df.assign(ID="San Juan"), df.assign(ID="Twice", mean=df['mean'] * 2)], ignore_index=True)
+        out = tempfile.mkdtemp()
+        try:
+            df[df['date'] <= "2017-12-01"].to_csv(os.path.join(out, "old.csv"))
+            df[df['date'] > "2017-12-01"].to_csv(os.path.join(out, "new.csv"))
+            state = os.path.join(out, "state.npz")
+            run_arima(os.path.join(out, "old.csv"), os.path.join(out, "old_ARIMA.csv"), 3, "2017/08/15", 2, state)
+            gdf = update_arima(state, os.path.join(out, "new.csv"), os.path.join(out, "new_ARIMA.csv"))
+        finally:
+            shutil.rmtree(out)
+        base = batch_trend(df, 3, "2017/08/15", 2)
+        base = base[base['date'] > "2017-12-01"]
+        assert list(gdf['ID']) == list(base['ID'])
+        pd.testing.assert_series_equal(gdf['SeasonalForecast'].reset_index(drop=True), base['SeasonalForecast'].reset_index(drop=True))
+
+    def test_cutoff_sweep(self):
+        """Test that sweeping cutoff dates matches running ARIMA at each cutoff"""
+        df = pd.read_csv(os.path.join(data_dir, "San_Juan_FullStats.csv")).sort_values(by=['date'])
+        # IDs ending before and after one another, with cutoffs on the last date and past it
+        df = pd.concat([df.assign(ID=1), df[:-3].assign(ID=2, mean=df['mean'][:-3] * 2 + 1),
+                        df[2:].assign(ID=35, mean=df['mean'][2:] * 1.5)], ignore_index=True)
+        cutoffs = ["2016/12/31", "2017/08/15", "2018/04/01", "2018/06/01", "2018/11/30"]
+        sweep = cutoff_sweep(df, cutoffs, 3, 2)
+        for CutoffDate in cutoffs:
+            base = batch_trend(df, 3, CutoffDate, 2)
+            result = sweep[sweep['CutoffDate'] == CutoffDate].set_index('ID')
+            assert sorted(result.index) == sorted(base['ID'].unique())
+            counts = base.groupby('ID')['Anomaly'].count()
+            assert (result.loc[counts.index, 'Anomalies'] == counts).all()
+            error = (base['SeasonalError_Pos'] - base['SeasonalForecast']).groupby(base['ID']).first()
+            assert np.allclose(result.loc[error.index, 'Error'], error)
+
+    def test_sarima(self):
+        """Test the seasonal ARIMA model flags a drop and reuses cached fits"""
+        pytest.importorskip("statsmodels")
+        dates = pd.date_range("2013-01-01", "2017-12-01", freq="MS")
+        y = 20 + 5 * np.sin(2 * np.pi * dates.month.values / 12) + np.random.RandomState(0).normal(0, 0.5, len(dates))
+        y[dates >= "2017-06-01"] -= 15
+        df = pd.DataFrame({'ID': 1, 'date': dates.strftime('%Y-%m-%d'), 'mean': y, 'count': 10})
+        orders = [((1, 0, 0), (0, 1, 1, 12))]
+        out = tempfile.mkdtemp()
+        try:
+            gdf = batch_sarima(df, "2016/12/31", 2, orders, out)
+            assert len(os.listdir(out)) == 1
+            cached = batch_sarima(df, "2016/12/31", 2, orders, out)
+        finally:
+            shutil.rmtree(out)
+        assert gdf[gdf['date'] >= "2017-06-01"]['Anomaly'].notna().all()
+        pd.testing.assert_frame_equal(gdf, cached)
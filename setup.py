@@ -10,7 +10,9 @@ inst_reqs = ["numpy", "pandas", "geopandas", "rasterio", "shapely", "fiona", "af
              "ipython", "ipywidgets", "tqdm", "scipy", "gdal"]
 
 extra_reqs = {
-    'test': ['mock', 'pytest', 'pytest-cov', 'codecov']}
+    'test': ['mock', 'pytest', 'pytest-cov', 'codecov'],
+    'parquet': ['pyarrow'],
+    'sarima': ['statsmodels']}
 
 setup(name='CometTS',
       version=version,